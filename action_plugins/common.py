@@ -1,5 +1,33 @@
-import subprocess
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
 import os
+import random
+import re
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+try:
+    import http.client as http_client
+except ImportError:
+    import httplib as http_client
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 
 from ansible.errors import AnsibleActionFail
 
@@ -9,6 +37,30 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+# Select how plugins talk to DC/OS: 'http' uses the REST APIs directly and
+# falls back to the cli when no cluster is configured, 'cli' always forks
+# the dcos binary.
+DCOS_BACKEND_ENV = 'DCOS_ANSIBLE_BACKEND'
+DCOS_HTTP_TIMEOUT = 60
+DCOS_HTTP_CHUNK_SIZE = 1024 * 1024
+
+# Upper bound for calls that plugins run concurrently against the cluster
+DCOS_CONCURRENCY_ENV = 'DCOS_ANSIBLE_CONCURRENCY'
+DCOS_CONCURRENCY = 8
+
+# Caches shared by all forks of one ansible run live below this directory,
+# the run is identified by the pid and start time of the controller process
+# that forked the workers.
+DCOS_RUN_ID_ENV = 'DCOS_ANSIBLE_RUN_ID'
+DCOS_RUN_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Caches that outlive a single run, e.g. rendered package apps
+DCOS_CACHE_DIR_ENV = 'DCOS_ANSIBLE_CACHE_DIR'
+
+# Task variable naming the cluster a task acts on, every cluster gets its own
+# cli config directory so tasks for different clusters can run in parallel
+DCOS_CLUSTER_VAR = 'dcos_cluster'
+
 def _version(v):
     return tuple(map(int, v.split('.')))
 
@@ -16,15 +68,49 @@ def _dcos_path():
     dcos_path = os.environ.copy()
     dcos_path["PATH"] = os.getcwd() + ':' + dcos_path["PATH"]
     dcos_path["DCOS_CLI_EXPERIMENTAL_AUTOINSTALL_PLUGINS"] = 'true'
+    if _cluster_dir is not None:
+        dcos_path["DCOS_DIR"] = _cluster_dir
+        # the cli would otherwise act on the cluster these point to
+        for name in ('DCOS_URL', 'DCOS_ACS_TOKEN', 'DCOS_CLUSTER'):
+            dcos_path.pop(name, None)
     display.vvv('dcos cli: path environment variable: {}'.format(dcos_path["PATH"]) )
     return dcos_path
 
+def _dcos_binary():
+    """Find the dcos binary on the PATH used to run cli commands."""
+    for d in _dcos_path()['PATH'].split(os.pathsep):
+        path = os.path.join(d, 'dcos')
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def _verify_once(name, check):
+    """Run a prerequisite check once per run and share the result between forks.
+
+    The result is keyed by the cli binary, its modification time and the
+    attached cluster, so upgrading the cli or switching clusters checks again.
+    """
+    binary = _dcos_binary()
+    mtime = os.path.getmtime(binary) if binary is not None else None
+    key = 'verified:{}:{}:{}:{}'.format(
+        name, binary, mtime, get_cluster_config().get('cluster_id'))
+
+    cache = run_cache()
+    with cache.lock(key):
+        if cache.get(key):
+            display.vvv("{}: prerequisites already verified".format(name))
+            return
+        check()
+        cache.set(key, True)
+
 def ensure_dcos():
     """Check whether the dcos cli is installed."""
+    _verify_once('dcos', _check_dcos)
 
+def _check_dcos():
     try:
         r = subprocess.check_output(['dcos', '--version'], env=_dcos_path()).decode()
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         raise AnsibleActionFail("DC/OS CLI is not installed!")
 
     # raw_version = ''
@@ -45,7 +131,9 @@ def ensure_dcos():
 
 def ensure_dcos_security():
     """Check whether the dcos[cli] security extension is installed."""
+    _verify_once('dcos security', _check_dcos_security)
 
+def _check_dcos_security():
     raw_version = ''
     try:
         r = subprocess.check_output(['dcos', 'security', '--version'], env=_dcos_path()).decode()
@@ -70,20 +158,839 @@ def install_dcos_security_cli():
     ]
     display.vvv(subprocess.check_output(cmd, env=_dcos_path()).decode())
 
-def run_command(cmd, description='run command', stop_on_error=False, input=None):
-    """Run a command and catch exceptions for Ansible."""
-    display.vvv("command: " + ' '.join(cmd))
+def run_command(cmd, description='run command', stop_on_error=False, input=None,
+                stderr=subprocess.STDOUT, mask=()):
+    """Run a command and catch exceptions for Ansible.
 
-    from subprocess import CalledProcessError, check_output
+    :param input: payload for the command's stdin, anything other than bytes
+                  or text is serialized to JSON
+    :param stderr: where stderr goes, pass subprocess.PIPE to keep it out of
+                   output that is parsed
+    :param mask: sensitive arguments that are hidden when logging the command,
+                 a masked command never logs its stdin either
+    """
+    display.vvv("command: " + ' '.join(
+        '********' if arg in mask else arg for arg in cmd))
 
-    try:
-        output = check_output(cmd, env=_dcos_path(),stderr=subprocess.STDOUT)
-        #output = check_output(cmd, env=_dcos_path())
-        returncode = 0
-    except CalledProcessError as e:
-        output = e.output
-        returncode = e.returncode
-        if stop_on_error and returncode != 0:
-             raise AnsibleActionFail('Failed to {}: {}'.format(description, e))
+    data = None
+    if input is not None:
+        if isinstance(input, bytes):
+            data = input
+        elif isinstance(input, str):
+            data = input.encode()
+        else:
+            data = json.dumps(input).encode()
+        if display.verbosity >= 4 and not mask:
+            display.vvvv("stdin: {}".format(data.decode('utf-8', 'replace')))
+
+    p = subprocess.Popen(cmd, env=_dcos_path(),
+                         stdin=subprocess.PIPE if data is not None else None,
+                         stdout=subprocess.PIPE, stderr=stderr)
+    output, errors = p.communicate(data)
+
+    if stop_on_error and p.returncode != 0:
+        raise AnsibleActionFail('Failed to {}: {}'.format(
+            description, (errors or output).decode('utf-8', 'replace')))
 
     return output
+
+def _dropped(e):
+    """Check whether an error means the server closed an idle connection."""
+    return isinstance(e, http_client.BadStatusLine) or getattr(e, 'errno', None) in (
+        errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+class DcosApiError(AnsibleActionFail):
+    """Raised when a DC/OS API call returns an unexpected status."""
+
+    def __init__(self, method, path, status, body):
+        self.status = status
+        self.body = body
+        super(DcosApiError, self).__init__(
+            'DC/OS API {} {} failed with status {}: {}'.format(
+                method, path, status, body))
+
+class DcosApi(object):
+    """Talk to the DC/OS REST APIs over keep-alive connections.
+
+    One connection is kept per thread and reused for every request, so a
+    task that issues many calls pays for the TCP and TLS handshake once.
+    """
+
+    def __init__(self, url, token, verify=True):
+        parsed = urlparse(url)
+        self.url = url.rstrip('/')
+        self.scheme = parsed.scheme or 'https'
+        self.netloc = parsed.netloc
+        self.prefix = parsed.path.rstrip('/')
+        self.token = token
+        self.verify = verify
+        self._local = threading.local()
+
+    def _connect(self, timeout=DCOS_HTTP_TIMEOUT):
+        if self.scheme == 'http':
+            return http_client.HTTPConnection(
+                self.netloc, timeout=timeout)
+
+        if self.verify is False:
+            context = ssl._create_unverified_context()
+        elif isinstance(self.verify, str):
+            context = ssl.create_default_context(cafile=self.verify)
+        else:
+            context = ssl.create_default_context()
+        return http_client.HTTPSConnection(
+            self.netloc, timeout=timeout, context=context)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def request(self, method, path, body=None, headers=None, ok=(200, 201, 204),
+                raw=False, stream=None, response_headers=None):
+        """Send a request and return the decoded JSON response, if any.
+
+        With raw the response body is returned as bytes. A body can also be
+        an open file, which is sent without reading it in memory. With stream
+        the response body is passed in chunks to that callable instead.
+        A response_headers dict is filled with the response headers, with
+        lower case names.
+        """
+        display.vvv('dcos api: {} {}'.format(method, path))
+
+        send_headers = {'Accept': 'application/json'}
+        if self.token:
+            send_headers['Authorization'] = 'token=' + self.token
+        if body is not None:
+            if hasattr(body, 'read'):
+                send_headers['Content-Length'] = str(os.fstat(body.fileno()).st_size)
+            elif not isinstance(body, bytes):
+                body = json.dumps(body).encode()
+            send_headers['Content-Type'] = 'application/json'
+        send_headers.update(headers or {})
+
+        # a pooled connection may have been closed by the server while idle,
+        # so retry once on a fresh connection
+        for attempt in range(2):
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            reused = getattr(self._local, 'conn', None) is not None
+            conn = self._connection()
+            response = None
+            try:
+                conn.request(method, self.prefix + path, body, send_headers)
+                response = conn.getresponse()
+                if stream is not None and response.status in ok:
+                    data = b''
+                    chunk = response.read(DCOS_HTTP_CHUNK_SIZE)
+                    while chunk:
+                        stream(chunk)
+                        chunk = response.read(DCOS_HTTP_CHUNK_SIZE)
+                else:
+                    data = response.read()
+                break
+            except (http_client.HTTPException, socket.error) as e:
+                self._reset()
+                # anything but a dropped idle connection may have reached the
+                # server, resending it could e.g. start a second deployment
+                if attempt > 0 or not reused or response is not None or not _dropped(e):
+                    raise AnsibleActionFail(
+                        'DC/OS API {} {} failed: {}'.format(method, path, e))
+
+        if response_headers is not None:
+            response_headers.update(
+                (k.lower(), v) for k, v in response.getheaders())
+
+        if response.status not in ok:
+            raise DcosApiError(method, path, response.status,
+                               data.decode('utf-8', 'replace'))
+
+        if raw:
+            return data
+        if stream is not None or not data:
+            return None
+        try:
+            return json.loads(data.decode())
+        except ValueError:
+            return data
+
+    def events(self, event_types, timeout=DCOS_HTTP_TIMEOUT):
+        """Subscribe to the Marathon event bus.
+
+        The subscription uses a connection of its own, so other requests can
+        be sent while it is open. Reading fails once no event arrived for
+        timeout seconds.
+
+        :return: EventStream of the decoded events
+        """
+        path = '/service/marathon/v2/events?' + '&'.join(
+            'event_type=' + t for t in event_types)
+        display.vvv('dcos api: GET {}'.format(path))
+
+        headers = {'Accept': 'text/event-stream'}
+        if self.token:
+            headers['Authorization'] = 'token=' + self.token
+
+        conn = self._connect(timeout)
+        try:
+            conn.request('GET', self.prefix + path, headers=headers)
+            response = conn.getresponse()
+        except (http_client.HTTPException, socket.error) as e:
+            conn.close()
+            raise AnsibleActionFail('DC/OS API GET {} failed: {}'.format(path, e))
+
+        if response.status != 200:
+            data = response.read()
+            conn.close()
+            raise DcosApiError('GET', path, response.status,
+                               data.decode('utf-8', 'replace'))
+        return EventStream(conn, response)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def find(self, path, **kwargs):
+        """GET a resource, or None if it does not exist."""
+        try:
+            return self.get(path, **kwargs)
+        except DcosApiError as e:
+            if e.status != 404:
+                raise
+            return None
+
+    def post(self, path, body=None, **kwargs):
+        return self.request('POST', path, body, **kwargs)
+
+    def put(self, path, body=None, **kwargs):
+        return self.request('PUT', path, body, **kwargs)
+
+    def patch(self, path, body=None, **kwargs):
+        return self.request('PATCH', path, body, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def cosmos(self, endpoint, body, request_version='v1', response_version='v1'):
+        """Call a Cosmos (package manager) endpoint with its versioned media types."""
+        media = 'application/vnd.dcos.package.{}-{}+json;charset=utf-8;version={}'
+        name = endpoint.replace('/', '.')
+        return self.post('/package/' + endpoint, body, headers={
+            'Content-Type': media.format(name, 'request', request_version),
+            'Accept': media.format(name, 'response', response_version),
+        })
+
+class EventStream(object):
+    """Iterate over the JSON events of a server-sent events response."""
+
+    def __init__(self, conn, response):
+        self.conn = conn
+        self.response = response
+
+    def __iter__(self):
+        data = []
+        while True:
+            line = self.response.readline()
+            if not line:
+                return
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            if line.startswith('data:'):
+                data.append(line[5:].strip())
+            elif not line and data:
+                yield json.loads('\n'.join(data))
+                data = []
+
+    def settimeout(self, timeout):
+        if self.conn.sock is not None:
+            self.conn.sock.settimeout(timeout)
+
+    def close(self):
+        self.conn.close()
+
+def _read_toml(path):
+    """Read the flat subset of TOML used by the dcos cli config files."""
+    config = {}
+    section = config
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('['):
+                section = config.setdefault(line.strip('[]').strip(), {})
+                continue
+            k, _, v = line.partition('=')
+            v = v.strip()
+            try:
+                section[k.strip()] = json.loads(v)
+            except ValueError:
+                section[k.strip()] = v.strip('\'')
+    return config
+
+def _dcos_dir():
+    if _cluster_dir is not None:
+        return _cluster_dir
+    return os.environ.get('DCOS_DIR') or os.path.expanduser('~/.dcos')
+
+_cluster_dir = None
+
+def select_cluster(task_vars):
+    """Use the cli config directory of the cluster named by the dcos_cluster variable.
+
+    Every ansible task runs in its own worker process, so the selection only
+    applies to the current task. Without the variable the default cli config
+    is used.
+    """
+    global _api, _cluster_dir
+
+    cluster = (task_vars or {}).get(DCOS_CLUSTER_VAR)
+    if not cluster:
+        return None
+
+    base = os.environ.get('DCOS_DIR') or os.path.expanduser('~/.dcos')
+    path = os.path.join(base, 'ansible-clusters',
+                        re.sub(r'[^A-Za-z0-9_.-]', '_', str(cluster)))
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path, 0o700)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    display.vvv('dcos cli: using config directory {}'.format(path))
+    with _api_lock:
+        _cluster_dir = path
+        _api = None
+    return path
+
+def get_cluster_config():
+    """Get the core config of the attached cluster from the dcos cli config."""
+    clusters = os.path.join(_dcos_dir(), 'clusters')
+    core = {}
+    try:
+        for cluster_id in os.listdir(clusters):
+            if os.path.exists(os.path.join(clusters, cluster_id, 'attached')):
+                config = _read_toml(
+                    os.path.join(clusters, cluster_id, 'dcos.toml'))
+                core = dict(config.get('core', {}), cluster_id=cluster_id)
+                break
+    except (IOError, OSError):
+        pass
+
+    # the environment applies to every cluster, so it cannot override a selected one
+    if _cluster_dir is not None:
+        return core
+    if os.environ.get('DCOS_URL'):
+        core['dcos_url'] = os.environ['DCOS_URL']
+    if os.environ.get('DCOS_ACS_TOKEN'):
+        core['dcos_acs_token'] = os.environ['DCOS_ACS_TOKEN']
+    return core
+
+_api = None
+_api_lock = threading.Lock()
+
+def dcos_api():
+    """Get the shared http backend, or None when the cli must be used."""
+    global _api
+
+    if os.environ.get(DCOS_BACKEND_ENV, 'http') == 'cli':
+        return None
+
+    with _api_lock:
+        if _api is not None:
+            return _api
+
+        config = get_cluster_config()
+        url = config.get('dcos_url')
+        token = config.get('dcos_acs_token')
+        if not url or not token:
+            display.vvv('dcos api: no cluster configured, using the cli')
+            return None
+
+        _api = DcosApi(url, token, ssl_verify(config))
+        return _api
+
+def ssl_verify(config):
+    """Get the TLS verification setting of a cluster config: a bool or a CA file."""
+    verify = config.get('ssl_verify', True)
+    if str(verify).lower() in ('false', 'true'):
+        verify = str(verify).lower() == 'true'
+    return verify
+
+def set_cluster_token(token):
+    """Store a new token in the cli config of the attached cluster.
+
+    :return: whether the token could be stored
+    """
+    cluster_id = get_cluster_config().get('cluster_id')
+    if cluster_id is None:
+        return False
+    path = os.path.join(_dcos_dir(), 'clusters', cluster_id, 'dcos.toml')
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    line = 'dcos_acs_token = "{}"'.format(token)
+    section = None
+    core_end = None
+    for i, l in enumerate(lines):
+        stripped = l.strip()
+        if stripped.startswith('['):
+            section = stripped.strip('[]').strip()
+            if section == 'core':
+                core_end = i + 1
+            continue
+        if section == 'core' and stripped:
+            core_end = i + 1
+            if stripped.partition('=')[0].strip() == 'dcos_acs_token':
+                lines[i] = line
+                break
+    else:
+        if core_end is None:
+            lines.extend(['[core]', line])
+        else:
+            lines.insert(core_end, line)
+
+    # write to a temporary file first so the cli never reads partial config
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp, path)
+
+    with _api_lock:
+        if _api is not None:
+            _api.token = token
+    return True
+
+def wait_for(check, timeout, description, delay=1, max_delay=30):
+    """Call check until it returns a true value or the timeout passes.
+
+    Waits between attempts grow exponentially up to max_delay, with random
+    jitter so that concurrent forks do not retry in lockstep.
+
+    :return: the value returned by check
+    """
+    deadline = time.time() + timeout
+    attempt = 0
+    while True:
+        value = check()
+        if value:
+            return value
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise AnsibleActionFail('Timed out after {}s waiting for {}'.format(
+                timeout, description))
+
+        backoff = min(max_delay, delay * 2 ** attempt)
+        time.sleep(min(random.uniform(backoff / 2.0, backoff), remaining))
+        attempt += 1
+
+DEPLOYMENT_ID_PATTERN = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+def deployment_id(response, headers=None):
+    """Get the Marathon deployment id from an api response or cli output, or None.
+
+    :param headers: response headers, pod endpoints only return the id there
+    """
+    if (headers or {}).get('marathon-deployment-id'):
+        return headers['marathon-deployment-id']
+    if isinstance(response, dict):
+        if response.get('deploymentId'):
+            return response['deploymentId']
+        deployments = response.get('deployments') or [{}]
+        return deployments[0].get('id')
+    if isinstance(response, bytes):
+        m = DEPLOYMENT_ID_PATTERN.search(response.decode('utf-8', 'replace'))
+        return m.group(0) if m else None
+    return None
+
+def list_deployments():
+    """List the running Marathon deployments."""
+    api = dcos_api()
+    if api is not None:
+        return api.get('/service/marathon/v2/deployments') or []
+
+    p = subprocess.Popen(
+        ['dcos', 'marathon', 'deployment', 'list', '--json'],
+        env=_dcos_path(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = p.communicate()
+    message = (output + errors).decode('utf-8', 'replace')
+    # some cli versions fail when there are no deployments
+    if p.returncode != 0 and 'no deployments' in message.lower():
+        return []
+    if p.returncode != 0:
+        raise AnsibleActionFail('Failed to list deployments: {}'.format(message))
+    try:
+        return json.loads(output) or []
+    except ValueError:
+        raise AnsibleActionFail('Failed to list deployments: {}'.format(message))
+
+def _deployment_ids(deployment):
+    """Get the deployment id and the ids of the apps and pods it affects."""
+    ids = set([deployment.get('id')])
+    ids.update(deployment.get('affectedApps') or [])
+    ids.update(deployment.get('affectedPods') or [])
+    for step in (deployment.get('plan') or {}).get('steps') or []:
+        for action in step.get('actions') or []:
+            ids.update(action[k] for k in ('app', 'pod') if action.get(k))
+    return ids
+
+def _deployment_matches(target, ids):
+    """Check whether a deployment id, or an app, pod or group id is affected."""
+    if target in ids:
+        return True
+    prefix = target.rstrip('/') + '/'
+    return target.startswith('/') and any(
+        i.startswith(prefix) for i in ids if i)
+
+# Statuses of deployments that did not fail, 'finished' when it was only
+# noticed that the deployment is not running anymore
+DEPLOYMENT_DONE = ('success', 'finished')
+
+def wait_for_deployments(targets, timeout):
+    """Wait until Marathon finished the deployments of the targets.
+
+    A target is a deployment id, or an app, pod or group id whose running
+    deployments are waited for. Finished deployments are taken from the
+    Marathon event stream, with backoff polling of the running deployments
+    when the stream is not available. Polling cannot tell whether a deployment
+    succeeded, so those targets finish with the status 'finished'.
+
+    :return: dict of target to a dict with the status ('success', 'failed',
+             'finished' or 'timeout') and the elapsed seconds
+    """
+    start = time.time()
+    deadline = start + timeout
+    pending = set(targets)
+    results = {}
+
+    def finish(target, status):
+        display.vvv('deployment of {}: {}'.format(target, status))
+        results[target] = {'status': status, 'elapsed': round(time.time() - start, 3)}
+        pending.discard(target)
+
+    def poll(targets=None, status='finished'):
+        """Finish the targets that no running deployment affects anymore."""
+        running = [_deployment_ids(d) for d in list_deployments()]
+        for t in list(pending if targets is None else targets):
+            if not any(_deployment_matches(t, ids) for ids in running):
+                finish(t, status)
+        return not pending
+
+    stream = None
+    api = dcos_api()
+    if api is not None:
+        try:
+            stream = api.events(['deployment_success', 'deployment_failed'], timeout)
+        except AnsibleActionFail as e:
+            display.vvv('marathon events not available, polling: {}'.format(e))
+
+    if stream is not None:
+        try:
+            # deployments may have finished before the subscription started
+            if not poll():
+                for event in stream:
+                    ids = _deployment_ids(event)
+                    status = 'success' if event.get('eventType') == 'deployment_success' else 'failed'
+                    affected = [t for t in pending
+                                if t.startswith('/') and _deployment_matches(t, ids)]
+                    if affected:
+                        # another deployment of the same app may still run,
+                        # e.g. the one that replaced a cancelled deployment
+                        poll(affected, status)
+                    for t in list(pending):
+                        if t == event.get('id'):
+                            finish(t, status)
+                    if not pending or time.time() > deadline:
+                        break
+                    stream.settimeout(deadline - time.time())
+        except (http_client.HTTPException, socket.error, ValueError) as e:
+            display.vvv('marathon events interrupted, polling: {}'.format(e))
+        finally:
+            stream.close()
+
+    if pending:
+        try:
+            wait_for(poll, max(0, deadline - time.time()), 'deployments')
+        except AnsibleActionFail:
+            # only the timeout is reported per target, failing to list is not
+            if time.time() < deadline:
+                raise
+    for t in list(pending):
+        finish(t, 'timeout')
+    return results
+
+def wait_for_deployment(target, timeout, description):
+    """Wait for a single deployment and fail if it failed or timed out.
+
+    :return: the elapsed seconds
+    """
+    r = wait_for_deployments([target], timeout)[target]
+    if r['status'] not in DEPLOYMENT_DONE:
+        raise AnsibleActionFail('Deployment of {} {} after {}s'.format(
+            description, 'timed out' if r['status'] == 'timeout' else 'failed',
+            r['elapsed']))
+    return r['elapsed']
+
+def run_concurrently(calls, description='run calls', max_workers=None):
+    """Run independent calls on a bounded thread pool.
+
+    All calls are run even if some of them fail, the failures are collected
+    and raised together once every call has finished.
+
+    :param calls: callables without arguments, e.g. functools.partial objects
+    :param max_workers: concurrency cap, defaults to DCOS_ANSIBLE_CONCURRENCY
+    :return: list of results in the order of calls
+    """
+    if max_workers is None:
+        max_workers = int(os.environ.get(DCOS_CONCURRENCY_ENV, DCOS_CONCURRENCY))
+
+    outcomes = []
+    if ThreadPoolExecutor is None or max_workers < 2 or len(calls) < 2:
+        for c in calls:
+            try:
+                outcomes.append((c(), None))
+            except Exception as e:
+                outcomes.append((None, e))
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as executor:
+            futures = [executor.submit(c) for c in calls]
+        for f in futures:
+            e = f.exception()
+            outcomes.append((f.result() if e is None else None, e))
+
+    errors = [str(e) for _, e in outcomes if e is not None]
+    if errors:
+        raise AnsibleActionFail('Failed to {}: {} of {} calls failed: {}'.format(
+            description, len(errors), len(calls), '; '.join(errors)))
+    return [r for r, _ in outcomes]
+
+class FileCache(object):
+    """JSON values stored as files so that all ansible forks can share them."""
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.isdir(root):
+            try:
+                os.makedirs(root, 0o700)
+            except OSError:
+                if not os.path.isdir(root):
+                    raise
+
+    def _path(self, key):
+        return os.path.join(
+            self.root, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def get(self, key, max_age=None):
+        """Get a cached value, or None when missing or older than max_age."""
+        path = self._path(key)
+        try:
+            if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        # write to a temporary file first so readers never see partial data
+        fd, tmp = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+        os.rename(tmp, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Hold an exclusive lock on a key across processes."""
+        with open(self._path(key) + '.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _cache_root():
+    return os.path.join(
+        tempfile.gettempdir(), 'ansible-dcos-{}'.format(os.getuid()))
+
+def _prune_run_caches(root):
+    """Remove caches left behind by earlier runs."""
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if time.time() - os.path.getmtime(path) > DCOS_RUN_CACHE_MAX_AGE:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+
+def _process_start(pid):
+    """Get the start time of a process, to tell apart processes with the same pid."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the command name may contain spaces, the fields after it do not
+            return f.read().rpartition(')')[2].split()[19]
+    except (IOError, OSError, IndexError):
+        pass
+    try:
+        return subprocess.check_output(
+            ['ps', '-o', 'lstart=', '-p', str(pid)]).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+def _run_id():
+    """Identify the run by the controller process that forked the workers."""
+    ppid = os.getppid()
+    start = _process_start(ppid)
+    if start is None:
+        return str(ppid)
+    return '{}-{}'.format(ppid, hashlib.sha1(start.encode()).hexdigest()[:12])
+
+_run_cache = None
+
+def run_cache():
+    """Get the cache shared by all tasks and forks of the current run."""
+    global _run_cache
+
+    if _run_cache is None:
+        run_id = os.environ.get(DCOS_RUN_ID_ENV) or _run_id()
+        root = _cache_root()
+        path = os.path.join(root, 'run-' + run_id)
+        if not os.path.isdir(path):
+            FileCache(root)
+            _prune_run_caches(root)
+        _run_cache = FileCache(path)
+    return _run_cache
+
+_persistent_cache = None
+
+def persistent_cache():
+    """Get the cache that is kept between runs."""
+    global _persistent_cache
+
+    if _persistent_cache is None:
+        root = os.environ.get(DCOS_CACHE_DIR_ENV) or os.path.join(
+            os.path.expanduser('~'), '.cache', 'ansible-dcos')
+        _persistent_cache = FileCache(root)
+    return _persistent_cache
+
+def _snapshot_key(kind):
+    config = get_cluster_config()
+    cluster = config.get('cluster_id') or config.get('dcos_url')
+    return 'snapshot:{}:{}'.format(cluster, kind)
+
+def get_snapshot(kind, fetch):
+    """Get a collection indexed by id, fetched once per run.
+
+    :param kind: name of the resource collection, e.g. 'marathon-apps'
+    :param fetch: callable returning the collection as a dict keyed by id
+    :return: dict of id to resource
+    """
+    key = _snapshot_key(kind)
+    cache = run_cache()
+    with cache.lock(key):
+        snapshot = cache.get(key)
+        if snapshot is None:
+            display.vvv('snapshot: fetching {}'.format(kind))
+            snapshot = fetch()
+            cache.set(key, snapshot)
+    return snapshot
+
+def update_snapshot(kind, resource_id, resource=None):
+    """Patch a cached collection after changing one of its resources.
+
+    A resource of None removes it from the collection.
+    """
+    key = _snapshot_key(kind)
+    cache = run_cache()
+    with cache.lock(key):
+        snapshot = cache.get(key)
+        if snapshot is None:
+            return
+        if resource is None:
+            snapshot.pop(resource_id, None)
+        else:
+            snapshot[resource_id] = resource
+        cache.set(key, snapshot)
+
+def invalidate_snapshot(kind):
+    """Drop a cached collection so the next lookup fetches it again."""
+    key = _snapshot_key(kind)
+    cache = run_cache()
+    with cache.lock(key):
+        cache.delete(key)
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+# Marathon assigns a port for these when they are 0
+MARATHON_ASSIGNED_PORTS = ('port', 'servicePort', 'hostPort')
+
+def _any_port(value):
+    """Check whether a wanted port of 0 leaves the choice to Marathon."""
+    try:
+        return not isinstance(value, bool) and float(value) == 0
+    except (TypeError, ValueError):
+        return False
+
+def diff_config(wanted, current, path=''):
+    """Compare wanted settings against a current definition.
+
+    Only keys set in wanted are compared, so defaults filled in by DC/OS are
+    ignored. Numbers are compared by value and scalars by their string form,
+    because values templated by Ansible often arrive as strings. Ports of 0
+    match any port, because Marathon stores the port it assigned.
+
+    :return: list of paths of the settings that differ
+    """
+    if isinstance(wanted, dict):
+        if not isinstance(current, dict):
+            return [path or '/']
+        diffs = []
+        for k, v in wanted.items():
+            p = '{}/{}'.format(path, k)
+            if k in MARATHON_ASSIGNED_PORTS and _any_port(v):
+                continue
+            if k == 'ports' and isinstance(v, list) and isinstance(current.get(k), list) \
+                    and len(v) == len(current[k]):
+                diffs.extend(diff_config(
+                    [c if _any_port(w) else w for w, c in zip(v, current[k])],
+                    current[k], p))
+                continue
+            if current.get(k) is None:
+                if v not in (None, [], {}, ''):
+                    diffs.append(p)
+                continue
+            diffs.extend(diff_config(v, current[k], p))
+        return diffs
+
+    if isinstance(wanted, list):
+        if not isinstance(current, list) or len(wanted) != len(current):
+            return [path]
+        diffs = []
+        for i, (w, c) in enumerate(zip(wanted, current)):
+            diffs.extend(diff_config(w, c, '{}/{}'.format(path, i)))
+        return diffs
+
+    if _is_number(wanted) or _is_number(current):
+        try:
+            equal = float(wanted) == float(current)
+        except (TypeError, ValueError):
+            equal = False
+    elif isinstance(wanted, bool) or isinstance(current, bool):
+        equal = str(wanted).lower() == str(current).lower()
+    else:
+        equal = wanted == current or str(wanted) == str(current)
+    return [] if equal else [path]
@@ -9,6 +9,7 @@ __metaclass__ = type
 import base64
 import json
 import subprocess
+import threading
 import time
 import os
 import sys
@@ -18,13 +19,31 @@ try:
 except ImportError:
     from urlparse import urlparse
 
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+except ImportError:
+    rsa = None
+
 from ansible.plugins.action import ActionBase
 from ansible.errors import AnsibleActionFail
 
 # to prevent duplicating code, make sure we can import common stuff
 sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
-from action_plugins.common import ensure_dcos, run_command, _dcos_path
+from action_plugins.common import (
+    ensure_dcos,
+    select_cluster,
+    run_command,
+    _dcos_path,
+    _dcos_dir,
+    get_cluster_config,
+    run_cache,
+    ssl_verify,
+    set_cluster_token,
+    DcosApi
+)
 
 try:
     from __main__ import display
@@ -43,41 +62,79 @@ DCOS_AUTH_OPTS = [
 ]
 DCOS_CONNECT_OPTS = DCOS_AUTH_OPTS + ['ca_certs']
 
+# Tokens expiring within this many seconds are refreshed in the background,
+# tokens expiring within the minimum validity are refreshed before going on
+DCOS_TOKEN_REFRESH_AHEAD = 60 * 60
+DCOS_TOKEN_MIN_VALIDITY = 5 * 60
+
+# Lifetime of the login tokens signed for service accounts, they are only
+# used once to obtain the actual token
+DCOS_LOGIN_TOKEN_LIFETIME = 5 * 60
+
+def _list_clusters():
+    """List the clusters set up in the cli config, indexed by netloc, name and id."""
+    clusters = {}
+    r = subprocess.check_output(['dcos', 'cluster', 'list', '--json'], env=_dcos_path())
+    for c in json.loads(r):
+        clusters['name:' + c['name']] = c
+        clusters['id:' + c['cluster_id']] = c
+        clusters['netloc:' + urlparse(c['url']).netloc] = c
+    return clusters
+
+def _clusters_key():
+    return 'clusters:{}'.format(_dcos_dir())
+
+def find_cluster(name=None, url=None):
+    """Find a cluster set up in the cli config by url or name.
+
+    The cluster list is fetched once per run and shared by all tasks.
+    """
+    key = _clusters_key()
+    cache = run_cache()
+    with cache.lock(key):
+        clusters = cache.get(key)
+        if clusters is None:
+            clusters = _list_clusters()
+            cache.set(key, clusters)
+
+    if url is not None and 'netloc:' + urlparse(url).netloc in clusters:
+        return clusters['netloc:' + urlparse(url).netloc]
+    return clusters.get('name:{}'.format(name)) or clusters.get('id:{}'.format(name))
+
+def forget_clusters():
+    """Drop the cached cluster list after setting up a cluster."""
+    run_cache().delete(_clusters_key())
+
 def check_cluster(name=None, url=None):
     """Check whether cluster is already setup.
 
+    Which cluster is wanted is decided once per run, later checks only
+    verify that it is still attached.
+
     :param url: url of the cluster
     :return: boolean whether cluster is already setup
     """
+    key = 'cluster:{}:{}:{}'.format(_dcos_dir(), name, url)
+    cache = run_cache()
+    attached_id = get_cluster_config().get('cluster_id')
 
-    if url is not None:
-        fqdn = urlparse(url).netloc
-    else:
-        fqdn = None
-
-    attached_cluster = None
-    wanted_cluster = None
-
-    clusters = subprocess.check_output(['dcos', 'cluster', 'list', '--json'], env=_dcos_path())
-    for c in json.loads(clusters):
-        if fqdn == urlparse(c['url']).netloc:
-            wanted_cluster = c
-        elif c['name'] == name:
-            wanted_cluster = c
-        if c['attached'] is True:
-            attached_cluster = c
+    wanted_id = cache.get(key)
+    if wanted_id is not None and wanted_id == attached_id:
+        display.vvv('DC/OS cluster {} already attached'.format(wanted_id))
+        return True
 
+    wanted_cluster = find_cluster(name, url)
     display.vvv('wanted:\n{}\nattached:\n{}\n'.format(wanted_cluster,
-                                                      attached_cluster))
+                                                      attached_id))
 
     if wanted_cluster is None:
         return False
-    elif wanted_cluster == attached_cluster:
-        return True
-    else:
+
+    if wanted_cluster['cluster_id'] != attached_id:
         subprocess.check_call(
             ['dcos', 'cluster', 'attach', wanted_cluster['cluster_id']], env=_dcos_path())
-        return True
+    cache.set(key, wanted_cluster['cluster_id'])
+    return True
 
 
 def parse_connect_options(cluster_options=True, **kwargs):
@@ -92,27 +149,131 @@ def parse_connect_options(cluster_options=True, **kwargs):
     return cli_args
 
 
+def token_expiry(token):
+    """Get the expiry time of a JWT, or None if it cannot be decoded."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload).decode())['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+def _token_remaining():
+    """Get the seconds until the token of the attached cluster expires."""
+    exp = token_expiry(get_cluster_config().get('dcos_acs_token'))
+    if exp is None:
+        return None
+    return exp - time.time()
+
+def _auth_key():
+    return 'auth:{}'.format(get_cluster_config().get('cluster_id'))
+
+def _refresh_if_expiring(**connect_args):
+    """Log in again unless another fork already refreshed the token."""
+    key = _auth_key()
+    cache = run_cache()
+    with cache.lock(key):
+        remaining = _token_remaining()
+        if remaining is None or remaining < DCOS_TOKEN_REFRESH_AHEAD:
+            refresh_auth(**connect_args)
+            remaining = _token_remaining()
+        if remaining is not None:
+            cache.set(key, {'exp': time.time() + remaining})
+
+def _refresh_in_background(**connect_args):
+    try:
+        _refresh_if_expiring(**connect_args)
+    except Exception as e:
+        display.warning('DC/OS auth: background token refresh failed: {}'.format(e))
+
 def ensure_auth(**connect_args):
-    valid = False
-    r = run_command(['dcos', 'config', 'show', 'core.dcos_acs_token'])
+    """Make sure the token of the attached cluster stays valid for the run.
+
+    The token expiry is shared by all tasks and forks of the run. A token
+    that expires within DCOS_TOKEN_REFRESH_AHEAD is refreshed in the
+    background while the current one is still used, one that is about to
+    expire is refreshed right away.
+
+    :return: whether the token is refreshed
+    """
+    if not any(connect_args.get(k) is not None for k in DCOS_AUTH_OPTS):
+        display.vvv('DC/OS auth: no credentials given, keeping the current token')
+        return False
+
+    record = run_cache().get(_auth_key())
+    if record is not None and record['exp'] - time.time() > DCOS_TOKEN_REFRESH_AHEAD:
+        display.vvv('DC/OS auth: token valid for this run')
+        return False
+
+    remaining = _token_remaining()
+    if remaining is not None and remaining > DCOS_TOKEN_REFRESH_AHEAD:
+        run_cache().set(_auth_key(), {'exp': time.time() + remaining})
+        return False
+
+    if remaining is not None and remaining > DCOS_TOKEN_MIN_VALIDITY:
+        display.vvv('DC/OS auth: token expires in {}s, refreshing in the background'.format(
+            int(remaining)))
+        # not a daemon thread, so the worker waits for it before exiting
+        threading.Thread(target=_refresh_in_background,
+                         kwargs=connect_args).start()
+        return True
+
+    display.vvv('DC/OS auth: token missing or expired, refreshing')
+    _refresh_if_expiring(**connect_args)
+    return True
+
 
-    if r.returncode == 0:
-        parts = r.stdout.read().decode().split('.')
-        info = json.loads(base64.b64decode(parts[1]))
-        exp = int(info['exp'])
-        limit = int(time.time()) + 5 * 60
-        if exp > limit:
-            valid = True
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
 
-    if not valid:
-        refresh_auth(**connect_args)
+def service_login_token(uid, private_key_pem):
+    """Build an RS256 signed login token for a service account."""
+    key = serialization.load_pem_private_key(
+        private_key_pem, password=None, backend=default_backend())
+    header = _b64url(json.dumps({'alg': 'RS256', 'typ': 'JWT'}).encode())
+    claims = _b64url(json.dumps({
+        'uid': uid,
+        'exp': int(time.time()) + DCOS_LOGIN_TOKEN_LIFETIME,
+    }).encode())
+    message = header + b'.' + claims
+    signature = key.sign(message, padding.PKCS1v15(), hashes.SHA256())
+    return (message + b'.' + _b64url(signature)).decode()
 
+def local_login(uid, private_key):
+    """Log in a service account without the cli.
+
+    The login token is signed in-process and exchanged with the IAM login
+    endpoint, the returned token is stored in the cli config.
+
+    :param private_key: path to the private key of the service account
+    :return: whether the login was done, False when it needs the cli
+    """
+    config = get_cluster_config()
+    if rsa is None or not config.get('dcos_url') or config.get('cluster_id') is None:
+        return False
+
+    display.vvv('DC/OS auth: logging in service account {}'.format(uid))
+    with open(os.path.expanduser(private_key), 'rb') as f:
+        token = service_login_token(uid, f.read())
+
+    api = DcosApi(config['dcos_url'], None, ssl_verify(config))
+    r = api.post('/acs/api/v1/auth/login', {'uid': uid, 'token': token})
+    return set_cluster_token(r['token'])
 
 def refresh_auth(**kwargs):
-    """Run the authentication command using the DC/OS CLI."""
+    """Run the authentication command using the DC/OS CLI.
+
+    Service accounts log in without the cli unless local_login is false.
+    """
+    if kwargs.get('private_key') and kwargs.get('username') and \
+            kwargs.get('local_login', True):
+        if local_login(kwargs['username'], kwargs['private_key']):
+            return None
+
     cli_args = parse_connect_options(False, **kwargs)
     return run_command(['dcos', 'auth', 'login'] + cli_args,
-                       'refresh auth token', True)
+                       'refresh auth token', True,
+                       mask=tuple(v for k, v in kwargs.items() if k == 'password'))
 
 
 def connect_cluster(**kwargs):
@@ -129,12 +290,16 @@ def connect_cluster(**kwargs):
         display.vvv('DC/OS cluster not setup, setting up')
 
         cli_args = parse_connect_options(**kwargs)
-        display.vvv('args: {}'.format(cli_args))
+        mask = tuple(v for k, v in kwargs.items() if k == 'password')
+        display.vvv('args: {}'.format(
+            ['********' if arg in mask else arg for arg in cli_args]))
 
         subprocess.check_call(['dcos', 'cluster', 'setup', url] + cli_args, env=_dcos_path())
+        forget_clusters()
         changed = True
 
-    # ensure_auth(**kwargs)
+    if ensure_auth(**kwargs):
+        changed = True
     return changed
 
 
@@ -152,6 +317,7 @@ class ActionModule(ActionBase):
 
         args = self._task.args
 
+        select_cluster(task_vars)
         ensure_dcos()
 
         result['changed'] = connect_cluster(**args)
@@ -0,0 +1,105 @@
+"""
+Action plugin to configure a DC/OS cluster.
+Uses the Ansible host to connect directly to DC/OS.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+
+from ansible.plugins.action import ActionBase
+from ansible.errors import AnsibleActionFail
+
+# to prevent duplicating code, make sure we can import common stuff
+sys.path.append(os.getcwd())
+sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
+from action_plugins.common import (
+    ensure_dcos,
+    select_cluster,
+    wait_for_deployments,
+    DEPLOYMENT_ID_PATTERN,
+    DEPLOYMENT_DONE
+)
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+def deployment_targets(items):
+    """Get the deployments to wait for from ids and registered task results.
+
+    :param items: deployment ids, app, pod or group ids, or results of
+                  dcos_marathon tasks, also when registered in a loop
+    :return: list of deployment ids and app, pod or group ids
+    """
+    targets = []
+    for item in items:
+        if isinstance(item, dict):
+            if 'results' in item:
+                targets.extend(deployment_targets(item['results']))
+                continue
+            if item.get('deployment_id'):
+                targets.append(item['deployment_id'])
+                continue
+            resource_id = item.get('app_id') or item.get('pod_id') or item.get('group_id')
+            if resource_id:
+                targets.append('/' + resource_id.strip('/'))
+            elif 'deployment_id' in item:
+                display.warning('dcos_deployment_wait: skipping a deployment without id')
+            continue
+        item = str(item).strip()
+        if DEPLOYMENT_ID_PATTERN.match(item) and len(item) == 36:
+            targets.append(item)
+        elif item.strip('/'):
+            # ensure ids have a single leading forward slash
+            targets.append('/' + item.strip('/'))
+
+    # keep the order but wait for every target once
+    seen = set()
+    return [t for t in targets if not (t in seen or seen.add(t))]
+
+class ActionModule(ActionBase):
+    def run(self, tmp=None, task_vars=None):
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+
+        if self._play_context.check_mode:
+            # in --check mode, always skip this module execution
+            result['skipped'] = True
+            result['msg'] = 'The dcos task does not support check mode'
+            return result
+
+        args = self._task.args
+        deployments = args.get('deployments')
+        timeout = int(args.get('timeout', 600))
+
+        if deployments is None:
+            raise AnsibleActionFail('deployments cannot be empty for dcos_deployment_wait')
+        if not isinstance(deployments, list):
+            deployments = [deployments]
+
+        targets = deployment_targets(deployments)
+
+        select_cluster(task_vars)
+        ensure_dcos()
+
+        results = wait_for_deployments(targets, timeout) if targets else {}
+
+        failed = [t for t in targets if results[t]['status'] not in DEPLOYMENT_DONE]
+        for t in failed:
+            display.vvv("DC/OS: deployment of {} {}".format(t, results[t]['status']))
+
+        result['changed'] = False
+        result['deployments'] = results
+        result['failed_deployments'] = failed
+        if failed:
+            result['failed'] = True
+            result['msg'] = '{} of {} deployments did not finish: {}'.format(
+                len(failed), len(targets), ', '.join(
+                    '{} ({})'.format(t, results[t]['status']) for t in failed))
+        return result
@@ -8,8 +8,6 @@ __metaclass__ = type
 
 import json
 import subprocess
-import tempfile
-import time
 import os
 import sys
 
@@ -19,7 +17,17 @@ from ansible.errors import AnsibleActionFail
 # to prevent duplicating code, make sure we can import common stuff
 sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
-from action_plugins.common import ensure_dcos, run_command, _dcos_path
+from action_plugins.common import (
+    ensure_dcos,
+    select_cluster,
+    run_command,
+    _dcos_path,
+    dcos_api,
+    diff_config,
+    get_cluster_config,
+    run_cache,
+    wait_for
+)
 
 try:
     from __main__ import display
@@ -27,27 +35,49 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
-def ensure_dcos_edgelb(instance_name):
-    """Check whether the dcos[cli] edgelb extension is installed."""
+EDGELB_READY_TIMEOUT = 60
 
-    tries = 3
-    for i in range(tries):
-        try:
+def ping_edgelb(instance_name):
+    """Check whether the Edge-LB API server answers."""
+    api = dcos_api()
+    try:
+        if api is not None:
+            api.get('/service/{}/ping'.format(instance_name), raw=True)
+        else:
             subprocess.check_output([
                     'dcos',
                     'edgelb',
                     '--name=' + instance_name,
                     'ping'
-                    ], env=_dcos_path()).decode()
-        except:
-            if i < tries - 1:
-                display.vvv("dcos edgelb: ping failed {} times".format(i+1))
-                install_dcos_edgelb_cli()
-                time.sleep(10)
-                continue
-            else:
-                raise AnsibleActionFail('Edge-LB: Pool cannot be configured because the API server is not reachable.')
-        break
+                    ], env=_dcos_path(), stderr=subprocess.STDOUT)
+    except (AnsibleActionFail, subprocess.CalledProcessError, OSError) as e:
+        display.vvv("dcos edgelb: ping failed: {}".format(e))
+        return False
+    return True
+
+def ensure_dcos_edgelb(instance_name, timeout=EDGELB_READY_TIMEOUT):
+    """Wait until the Edge-LB API server is reachable.
+
+    A healthy instance is remembered for the rest of the run.
+    """
+    key = 'edgelb-ready:{}:{}'.format(
+        get_cluster_config().get('cluster_id'), instance_name)
+    cache = run_cache()
+    if cache.get(key):
+        display.vvv("dcos edgelb: {} already known to be healthy".format(instance_name))
+        return
+
+    if not ping_edgelb(instance_name):
+        if dcos_api() is None:
+            # the ping may have failed because the edgelb cli is missing
+            install_dcos_edgelb_cli()
+        try:
+            wait_for(lambda: ping_edgelb(instance_name), timeout,
+                     'the Edge-LB API server', delay=2)
+        except AnsibleActionFail:
+            raise AnsibleActionFail('Edge-LB: Pool cannot be configured because the API server is not reachable.')
+
+    cache.set(key, True)
 
 def install_dcos_edgelb_cli():
     """Install DC/OS edgelb CLI"""
@@ -63,83 +93,104 @@ def install_dcos_edgelb_cli():
     ]
     display.vvv(subprocess.check_output(cmd, env=_dcos_path()).decode())
 
+def _pools_path(instance_name):
+    return '/service/{}/api/v2/pools'.format(instance_name)
+
+def _pool_api(options):
+    """Get the http backend for a pool, V1 pool definitions go through the cli.
+
+    Like the edgelb cli, a pool without apiVersion is a V1 pool.
+    """
+    if options.get('apiVersion') != 'V2':
+        return None
+    return dcos_api()
+
+def get_pool(pool_id, instance_name):
+    """Get the current definition of a pool, or None if it does not exist."""
+    api = dcos_api()
+    if api is not None:
+        return api.find(_pools_path(instance_name) + '/' + pool_id)
+
+    try:
+        r = subprocess.check_output([
+            'dcos',
+            'edgelb',
+            'show',
+            '--name=' + instance_name,
+            '--json',
+            pool_id
+            ], env=_dcos_path(), stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        return None
+    return json.loads(r)
+
+def pool_diff(options, pool):
+    """Get the settings in which a current pool differs from the wanted options.
+
+    Edge-LB fills in defaults for everything left out of a pool, those are
+    ignored by only comparing the settings given in the options.
+    """
+    if options.get('apiVersion') != 'V2':
+        # V1 definitions cannot be compared with the V2 pools Edge-LB returns
+        return ['/apiVersion']
+    return diff_config(options, pool)
+
 def get_pool_state(pool_id, instance_name):
     """Get the current state of a pool."""
-    r = subprocess.check_output([
-        'dcos',
-        'edgelb',
-        'list',
-        '--name=' + instance_name,
-        '--json'
-        ], env=_dcos_path())
-    pools = json.loads(r)
-
     display.vvv('looking for pool_id {}'.format(pool_id))
 
     state = 'absent'
-    for p in pools:
-        try:
-            if pool_id == p['name']:
-                state = 'present'
-                display.vvv('found pool: {}'.format(pool_id))
-
-        except KeyError:
-         continue
+    if get_pool(pool_id, instance_name) is not None:
+        state = 'present'
+        display.vvv('found pool: {}'.format(pool_id))
     return state
 
 def pool_create(pool_id, instance_name, options):
     """Create a pool"""
     display.vvv("DC/OS: edgelb create pool {}".format(pool_id))
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
-
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
+    api = _pool_api(options)
+    if api is not None:
+        api.post(_pools_path(instance_name), options)
+        return
 
-        display.vvv(subprocess.check_output(
-        ['cat', f.name]).decode())
-
-        cmd = [
-            'dcos',
-            'edgelb',
-            'create',
-            '--name=' + instance_name,
-            f.name
-        ]
-        run_command(cmd, 'update pool', stop_on_error=True)
+    cmd = [
+        'dcos',
+        'edgelb',
+        'create',
+        '--name=' + instance_name,
+        '/dev/stdin'
+    ]
+    run_command(cmd, 'create pool', stop_on_error=True, input=options)
 
 
 def pool_update(pool_id, instance_name, options):
     """Update an pool"""
     display.vvv("DC/OS: Edgelb update pool {}".format(pool_id))
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
-
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
-
-        display.vvv(subprocess.check_output(
-        ['cat', f.name]).decode())
+    api = _pool_api(options)
+    if api is not None:
+        api.put(_pools_path(instance_name) + '/' + pool_id, options)
+        return
 
-        cmd = [
-            'dcos',
-            'edgelb',
-            'update',
-            '--name=' + instance_name,
-            f.name
-        ]
-        run_command(cmd, 'update pool', stop_on_error=True)
+    cmd = [
+        'dcos',
+        'edgelb',
+        'update',
+        '--name=' + instance_name,
+        '/dev/stdin'
+    ]
+    run_command(cmd, 'update pool', stop_on_error=True, input=options)
 
 def pool_delete(pool_id, instance_name):
     """Delete a pool"""
     display.vvv("DC/OS: Edge-LB delete pool {}".format(pool_id))
 
+    api = dcos_api()
+    if api is not None:
+        api.delete(_pools_path(instance_name) + '/' + pool_id)
+        return
+
     cmd = [
         'dcos',
         'edgelb',
@@ -165,16 +216,19 @@ class ActionModule(ActionBase):
         state = args.get('state', 'present')
 
         instance_name = args.get('instance_name', 'edgelb')
+        ready_timeout = int(args.get('ready_timeout', EDGELB_READY_TIMEOUT))
         # ensure pool_id has no leading forward slash
         pool_id = args.get('pool_id', '').strip('/')
 
         options = args.get('options') or {}
         options['name']= pool_id
 
+        select_cluster(task_vars)
         ensure_dcos()
-        ensure_dcos_edgelb(instance_name)
+        ensure_dcos_edgelb(instance_name, ready_timeout)
 
-        current_state = get_pool_state(pool_id, instance_name)
+        current_pool = get_pool(pool_id, instance_name)
+        current_state = 'present' if current_pool is not None else 'absent'
         wanted_state = state
 
         if current_state == wanted_state:
@@ -182,10 +236,15 @@ class ActionModule(ActionBase):
             display.vvv(
                 "edgelb pool {} already in desired state {}".format(pool_id, wanted_state))
 
-            if wanted_state == "present":
-                pool_update(pool_id, instance_name, options)
-
             result['changed'] = False
+
+            if wanted_state == "present":
+                diffs = pool_diff(options, current_pool)
+                if diffs:
+                    display.vvv("edgelb pool {} differs in {}".format(
+                        pool_id, ', '.join(diffs)))
+                    pool_update(pool_id, instance_name, options)
+                    result['changed'] = True
         else:
             display.vvv("edgelb pool {} not in desired state {}".format(pool_id, wanted_state))
 
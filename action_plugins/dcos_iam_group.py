@@ -13,6 +13,13 @@ import time
 import os
 import sys
 
+from functools import partial
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
 from ansible.plugins.action import ActionBase
 from ansible.errors import AnsibleActionFail
 
@@ -21,9 +28,15 @@ sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
 from action_plugins.common import (
     ensure_dcos,
+    select_cluster,
     ensure_dcos_security,
     run_command,
-    _dcos_path
+    _dcos_path,
+    dcos_api,
+    get_snapshot,
+    update_snapshot,
+    run_concurrently,
+    DcosApiError
 )
 
 try:
@@ -32,8 +45,12 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
-def get_group_state(gid):
-    """Get the current state of a group."""
+def _list_groups():
+    """List all groups indexed by gid."""
+    api = dcos_api()
+    if api is not None:
+        r = api.get('/acs/api/v1/groups')
+        return dict((i['gid'], i) for i in r['array'])
 
     r = subprocess.check_output([
         'dcos',
@@ -45,12 +62,14 @@ def get_group_state(gid):
         ],
         env=_dcos_path()
     )
-    groups = json.loads(r)
+    return json.loads(r)
 
+def get_group_state(gid):
+    """Get the current state of a group."""
     display.vvv('looking for gid {}'.format(gid))
 
     state = 'absent'
-    if gid in groups:
+    if gid in get_snapshot('iam-groups', _list_groups):
         state = 'present'
         display.vvv('found gid: {}'.format(gid))
 
@@ -60,6 +79,11 @@ def group_create(gid, description):
     """Create a group"""
     display.vvv("DC/OS: IAM create group {}".format(gid))
 
+    api = dcos_api()
+    if api is not None:
+        api.put('/acs/api/v1/groups/' + gid, {'description': description})
+        return
+
     cmd = [
         'dcos',
         'security',
@@ -72,30 +96,225 @@ def group_create(gid, description):
     ]
     run_command(cmd, 'create group', stop_on_error=True)
 
-def group_update(gid, permissions):
-    """Update group permissions"""
-    display.vvv("DC/OS: IAM update group {}".format(gid))
+def _acl_path(rid):
+    """IAM API path of an ACL, slashes in the rid must be double encoded."""
+    return '/acs/api/v1/acls/' + quote(rid.replace('/', '%2F'), safe=':')
 
-    for p in permissions:
-        display.vvv("Granting {} permission on {} to group {}".format(
-            p['rid'], p['action'], gid))
+def get_group_permissions(gid):
+    """Get the permissions of a group as a set of (rid, action) tuples.
 
-        cmd = [
+    Returns None if the cli does not report the permissions of the group.
+    """
+    api = dcos_api()
+    if api is not None:
+        entries = api.get('/acs/api/v1/groups/{}/permissions'.format(gid))['array']
+    else:
+        r = subprocess.check_output([
             'dcos',
             'security',
             'org',
             'groups',
-            'grant',
-            gid,
-            p['rid'],
-            p['action']
-        ]
-        run_command(cmd, 'update group', stop_on_error=False)
+            'show',
+            '--json',
+            gid
+            ],
+            env=_dcos_path()
+        )
+        entries = json.loads(r).get(gid, {}).get('permissions')
+        if entries is None:
+            return None
+
+    permissions = set()
+    for e in entries:
+        for a in e.get('actions', []):
+            permissions.add((e['rid'], a['name'] if isinstance(a, dict) else a))
+    return permissions
+
+def group_grant(gid, rid, action):
+    """Grant a permission to a group, creating the ACL if needed"""
+    display.vvv("Granting {} permission on {} to group {}".format(
+        action, rid, gid))
+
+    api = dcos_api()
+    if api is not None:
+        path = '{}/groups/{}/{}'.format(_acl_path(rid), gid, action)
+        try:
+            # 409 means the permission was already granted
+            api.put(path, ok=(204, 409))
+        except DcosApiError as e:
+            if e.status != 404:
+                raise
+            api.put(_acl_path(rid), {'description': 'Created by Ansible'},
+                    ok=(201, 409))
+            api.put(path, ok=(204, 409))
+        return
+
+    cmd = [
+        'dcos',
+        'security',
+        'org',
+        'groups',
+        'grant',
+        gid,
+        rid,
+        action
+    ]
+    run_command(cmd, 'update group', stop_on_error=False)
+
+def group_revoke(gid, rid, action):
+    """Revoke a permission from a group"""
+    display.vvv("Revoking {} permission on {} from group {}".format(
+        action, rid, gid))
+
+    api = dcos_api()
+    if api is not None:
+        api.delete('{}/groups/{}/{}'.format(_acl_path(rid), gid, action))
+        return
+
+    cmd = [
+        'dcos',
+        'security',
+        'org',
+        'groups',
+        'revoke',
+        gid,
+        rid,
+        action
+    ]
+    run_command(cmd, 'revoke permission', stop_on_error=True)
+
+def get_user_groups(uid):
+    """Get the groups a user or service account is a member of.
+
+    Returns None if the cli does not report the groups of the user.
+    """
+    api = dcos_api()
+    if api is not None:
+        r = api.get('/acs/api/v1/users/{}/groups'.format(uid))
+        return set(m['group']['gid'] for m in r['array'])
+
+    r = subprocess.check_output([
+        'dcos',
+        'security',
+        'org',
+        'users',
+        'show',
+        '--json',
+        uid
+        ],
+        env=_dcos_path()
+    )
+    groups = json.loads(r).get(uid, {}).get('groups')
+    if groups is None:
+        return None
+    return set(g['gid'] if isinstance(g, dict) else g for g in groups)
+
+def group_add_user(gid, uid):
+    """Add a user or service account to a group"""
+    display.vvv("Assigning {} to group {}".format(uid, gid))
+
+    api = dcos_api()
+    if api is not None:
+        # 409 means the user is already a member
+        api.put('/acs/api/v1/groups/{}/users/{}'.format(gid, uid), ok=(204, 409))
+        return
+
+    cmd = [
+        'dcos',
+        'security',
+        'org',
+        'groups',
+        'add_user',
+        gid,
+        uid
+    ]
+    run_command(cmd, 'add user to group', stop_on_error=False)
+
+def group_remove_user(gid, uid):
+    """Remove a user or service account from a group"""
+    display.vvv("Removing {} from group {}".format(uid, gid))
+
+    api = dcos_api()
+    if api is not None:
+        api.delete('/acs/api/v1/groups/{}/users/{}'.format(gid, uid))
+        return
+
+    cmd = [
+        'dcos',
+        'security',
+        'org',
+        'groups',
+        'remove_user',
+        gid,
+        uid
+    ]
+    run_command(cmd, 'remove user from group', stop_on_error=True)
+
+def group_update(gid, permissions, purge=False):
+    """Update group permissions
+
+    Only missing permissions are granted. With purge, permissions that are
+    not listed are revoked.
+
+    :return: whether permissions were granted or revoked
+    """
+    display.vvv("DC/OS: IAM update group {}".format(gid))
+
+    wanted = set((p['rid'], p['action']) for p in permissions)
+    current = get_group_permissions(gid)
+
+    if current is None:
+        # the current permissions are unknown, grant all of them
+        run_concurrently([partial(group_grant, gid, rid, action)
+                          for rid, action in sorted(wanted)],
+                         'update group')
+        return False
+
+    missing = wanted - current
+    extra = current - wanted if purge else set()
+
+    calls = [partial(group_grant, gid, rid, action)
+             for rid, action in sorted(missing)]
+    calls.extend(partial(group_revoke, gid, rid, action)
+                 for rid, action in sorted(extra))
+    run_concurrently(calls, 'update group')
+    return len(calls) > 0
+
+def update_user_groups(uid, groups, purge=False):
+    """Update the group memberships of a user or service account
+
+    Only missing memberships are added. With purge, the user is removed
+    from groups that are not listed.
+
+    :return: whether memberships were added or removed
+    """
+    wanted = set(groups)
+    current = get_user_groups(uid)
+
+    if current is None:
+        # the current memberships are unknown, add all of them
+        run_concurrently([partial(group_add_user, g, uid)
+                          for g in sorted(wanted)],
+                         'update group memberships')
+        return False
+
+    calls = [partial(group_add_user, g, uid)
+             for g in sorted(wanted - current)]
+    if purge:
+        calls.extend(partial(group_remove_user, g, uid)
+                     for g in sorted(current - wanted))
+    run_concurrently(calls, 'update group memberships')
+    return len(calls) > 0
 
 def group_delete(gid):
     """Delete a group"""
     display.vvv("DC/OS: IAM delete group {}".format(gid))
 
+    api = dcos_api()
+    if api is not None:
+        api.delete('/acs/api/v1/groups/' + gid)
+        return
+
     cmd = [
         'dcos',
         'security',
@@ -122,11 +341,13 @@ class ActionModule(ActionBase):
         gid = args.get('gid')
         description = args.get('description', 'Created by Ansible')
         permissions = args.get('permissions', [])
+        purge_permissions = args.get('purge_permissions', False)
         wanted_state = args.get('state', 'present')
 
         if gid is None:
             raise AnsibleActionFail('gid cannot be empty for dcos_iam_group')
 
+        select_cluster(task_vars)
         ensure_dcos()
         ensure_dcos_security()
 
@@ -137,19 +358,22 @@ class ActionModule(ActionBase):
             display.vvv(
                 "DC/OS IAM group {} already in desired state {}".format(gid, wanted_state))
 
-            if wanted_state == "present":
-                group_update(gid, permissions)
-
             result['changed'] = False
+
+            if wanted_state == "present":
+                result['changed'] = group_update(
+                    gid, permissions, purge_permissions)
         else:
             display.vvv("DC/OS: IAM group {} not in desired state {}".format(gid, wanted_state))
 
             if wanted_state != 'absent':
                 group_create(gid, description)
-                group_update(gid, permissions)
+                update_snapshot('iam-groups', gid, {'description': description})
+                group_update(gid, permissions, purge_permissions)
 
             else:
                 group_delete(gid)
+                update_snapshot('iam-groups', gid)
 
             result['changed'] = True
 
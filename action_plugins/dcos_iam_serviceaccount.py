@@ -7,12 +7,20 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import json
+import shutil
 import subprocess
 import tempfile
 import time
 import os
 import sys
 
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+except ImportError:
+    rsa = None
+
 from ansible.plugins.action import ActionBase
 from ansible.errors import AnsibleActionFail
 
@@ -21,23 +29,36 @@ sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
 from action_plugins.common import (
     ensure_dcos,
+    select_cluster,
     ensure_dcos_security,
     run_command,
-    _dcos_path
+    _dcos_path,
+    dcos_api,
+    get_snapshot,
+    update_snapshot,
+    run_concurrently
 )
+from action_plugins.dcos_iam_group import update_user_groups
 
 from action_plugins.dcos_secret import (
-    get_secret_value,
+    secret_exists,
+    _remember_exists,
+    secret_create,
     secret_delete
 )
+
 try:
     from __main__ import display
 except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
-def get_service_account_state(sid):
-    """Get the current state of a service_account."""
+def _list_service_accounts():
+    """List all service_accounts indexed by sid."""
+    api = dcos_api()
+    if api is not None:
+        r = api.get('/acs/api/v1/users?type=service')
+        return dict((i['uid'], i) for i in r['array'])
 
     r = subprocess.check_output([
         'dcos',
@@ -49,93 +70,126 @@ def get_service_account_state(sid):
         ],
         env=_dcos_path()
     )
-    service_accounts = json.loads(r)
+    return json.loads(r)
 
+def get_service_account_state(sid):
+    """Get the current state of a service_account."""
     display.vvv('looking for sid {}'.format(sid))
 
     state = 'absent'
-    if sid in service_accounts:
+    if sid in get_snapshot('iam-service-accounts', _list_service_accounts):
         state = 'present'
         display.vvv('found sid: {}'.format(sid))
 
     return state
 
-def service_account_create(sid, secret_path, store, description):
-    """Create a service_account"""
-    display.vvv("DC/OS: IAM create service_account {}".format(sid))
-
-    if get_secret_value(secret_path, store) is not None:
-        secret_delete(secret_path, store)
-
-    with tempfile.NamedTemporaryFile('w+') as f_private:
-        with tempfile.NamedTemporaryFile('w+') as f_public:
-
+def generate_keypair():
+    """Generate an RSA keypair for a service account.
+
+    :return: tuple of the private and public key as PEM text
+    """
+    if rsa is None:
+        # without the cryptography package let the cli write the keys
+        tmp = tempfile.mkdtemp()
+        try:
+            private_file = os.path.join(tmp, 'private.pem')
+            public_file = os.path.join(tmp, 'public.pem')
             cmd = [
                 'dcos',
                 'security',
                 'org',
                 'service-accounts',
                 'keypair',
-                f_private.name, f_public.name
+                private_file, public_file
             ]
-            run_command(cmd, 'create kepypairs', stop_on_error=True)
+            run_command(cmd, 'create keypair', stop_on_error=True)
+            with open(private_file) as f:
+                private_key = f.read()
+            with open(public_file) as f:
+                public_key = f.read()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return private_key, public_key
+
+    key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend())
+    private_key = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()).decode()
+    public_key = key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+    return private_key, public_key
+
+def service_account_secret(sid, private_key):
+    """Build the login secret of a service account, as create-sa-secret --strict does."""
+    return json.dumps({
+        'login_endpoint': 'https://leader.mesos/acs/api/v1/auth/login',
+        'private_key': private_key,
+        'scheme': 'RS256',
+        'uid': sid,
+    })
 
-            display.vvv(subprocess.check_output(
-                ['cat', f_private.name]).decode())
-            display.vvv(subprocess.check_output(
-                ['cat', f_public.name]).decode())
-
-            cmd = [
-                'dcos',
-                'security',
-                'org',
-                'service-accounts',
-                'create',
-                sid,
-                '--public-key',
-                f_public.name,
-                '--description',
-                description
-            ]
-            run_command(cmd, 'create service account', stop_on_error=True)
+def service_account_create(sid, secret_path, store, description):
+    """Create a service_account"""
+    display.vvv("DC/OS: IAM create service_account {}".format(sid))
 
-            cmd = [
-                'dcos',
-                'security',
-                'secrets',
-                'create-sa-secret',
-                '--store-id',
-                store,
-                '--strict',
-                f_private.name,
-                sid,
-                secret_path
-            ]
-            run_command(cmd, 'create service secret', stop_on_error=True)
+    if secret_exists(secret_path, store):
+        secret_delete(secret_path, store)
+        _remember_exists(secret_path, store, False)
 
-def service_account_update(sid, groups):
-    """Update service_account groups"""
-    display.vvv("DC/OS: IAM update service_account {}".format(sid))
+    private_key, public_key = generate_keypair()
 
-    for g in groups:
-        display.vvv("Assigning service_account {} to group {}".format(
-            sid,g))
+    def create_account():
+        api = dcos_api()
+        if api is not None:
+            api.put('/acs/api/v1/users/' + sid, {
+                'description': description,
+                'public_key': public_key,
+            })
+            return
 
         cmd = [
             'dcos',
             'security',
             'org',
-            'groups',
-            'add_user',
-            g,
-            sid
+            'service-accounts',
+            'create',
+            sid,
+            '--public-key',
+            '/dev/stdin',
+            '--description',
+            description
         ]
-        run_command(cmd, 'update service_account', stop_on_error=False)
+        run_command(cmd, 'create service account', stop_on_error=True,
+                    input=public_key)
+
+    def create_secret():
+        secret_create(secret_path, service_account_secret(sid, private_key), store)
+        _remember_exists(secret_path, store, True)
+
+    # the account and its secret only depend on the keypair
+    run_concurrently([create_account, create_secret],
+                     'create service account')
+
+def service_account_update(sid, groups, purge=False):
+    """Update service_account groups
+
+    :return: whether the group memberships changed
+    """
+    display.vvv("DC/OS: IAM update service_account {}".format(sid))
+    return update_user_groups(sid, groups, purge)
 
 def service_account_delete(sid):
     """Delete a service_account"""
     display.vvv("DC/OS: IAM delete service_account {}".format(sid))
 
+    api = dcos_api()
+    if api is not None:
+        api.delete('/acs/api/v1/users/' + sid)
+        return
+
     cmd = [
         'dcos',
         'security',
@@ -164,6 +218,7 @@ class ActionModule(ActionBase):
         secret_path = args.get('secret_path')
         store = args.get('store', 'default')
         groups = args.get('groups', [])
+        purge_groups = args.get('purge_groups', False)
         wanted_state = args.get('state', 'present')
 
         if sid is None:
@@ -172,6 +227,7 @@ class ActionModule(ActionBase):
         if secret_path is None:
             raise AnsibleActionFail('secret_path cannot be empty for dcos_iam_service_account')
 
+        select_cluster(task_vars)
         ensure_dcos()
         ensure_dcos_security()
 
@@ -186,22 +242,25 @@ class ActionModule(ActionBase):
 
             if wanted_state == "present":
 
-                if get_secret_value(secret_path, store) is None:
+                if not secret_exists(secret_path, store):
                     service_account_delete(sid)
                     service_account_create(sid, secret_path, store, description)
                     result['changed'] = True
 
-                service_account_update(sid, groups)
+                if service_account_update(sid, groups, purge_groups):
+                    result['changed'] = True
 
         else:
             display.vvv("DC/OS: IAM service_account {} not in desired state {}".format(sid, wanted_state))
 
             if wanted_state != 'absent':
                 service_account_create(sid, secret_path, store, description)
-                service_account_update(sid, groups)
+                update_snapshot('iam-service-accounts', sid, {'description': description})
+                service_account_update(sid, groups, purge_groups)
 
             else:
                 service_account_delete(sid)
+                update_snapshot('iam-service-accounts', sid)
 
             result['changed'] = True
 
@@ -21,10 +21,15 @@ sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
 from action_plugins.common import (
     ensure_dcos,
+    select_cluster,
     ensure_dcos_security,
     run_command,
-    _dcos_path
+    _dcos_path,
+    dcos_api,
+    get_snapshot,
+    update_snapshot
 )
+from action_plugins.dcos_iam_group import update_user_groups
 
 try:
     from __main__ import display
@@ -32,8 +37,12 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
-def get_user_state(uid):
-    """Get the current state of a user."""
+def _list_users():
+    """List all users indexed by uid."""
+    api = dcos_api()
+    if api is not None:
+        r = api.get('/acs/api/v1/users')
+        return dict((i['uid'], i) for i in r['array'])
 
     r = subprocess.check_output([
         'dcos',
@@ -45,12 +54,14 @@ def get_user_state(uid):
         ],
         env=_dcos_path()
     )
-    users = json.loads(r)
+    return json.loads(r)
 
+def get_user_state(uid):
+    """Get the current state of a user."""
     display.vvv('looking for uid {}'.format(uid))
 
     state = 'absent'
-    if uid in users:
+    if uid in get_snapshot('iam-users', _list_users):
         state = 'present'
         display.vvv('found uid: {}'.format(uid))
 
@@ -60,6 +71,14 @@ def user_create(uid, password, description):
     """Create a user"""
     display.vvv("DC/OS: IAM create user {}".format(uid))
 
+    api = dcos_api()
+    if api is not None:
+        api.put('/acs/api/v1/users/' + uid, {
+            'description': description,
+            'password': password,
+        })
+        return
+
     cmd = [
         'dcos',
         'security',
@@ -74,29 +93,23 @@ def user_create(uid, password, description):
     ]
     run_command(cmd, 'create user', stop_on_error=True)
 
-def user_update(uid, groups):
-    """Update user groups"""
-    display.vvv("DC/OS: IAM update user {}".format(uid))
+def user_update(uid, groups, purge=False):
+    """Update user groups
 
-    for g in groups:
-        display.vvv("Assigning user {} to group {}".format(
-            uid,g))
-
-        cmd = [
-            'dcos',
-            'security',
-            'org',
-            'groups',
-            'add_user',
-            g,
-            uid
-        ]
-        run_command(cmd, 'update user', stop_on_error=False)
+    :return: whether the group memberships changed
+    """
+    display.vvv("DC/OS: IAM update user {}".format(uid))
+    return update_user_groups(uid, groups, purge)
 
 def user_delete(uid):
     """Delete a user"""
     display.vvv("DC/OS: IAM delete user {}".format(uid))
 
+    api = dcos_api()
+    if api is not None:
+        api.delete('/acs/api/v1/users/' + uid)
+        return
+
     cmd = [
         'dcos',
         'security',
@@ -124,6 +137,7 @@ class ActionModule(ActionBase):
         description = args.get('description', 'Created by Ansible')
         password = args.get('password')
         groups = args.get('groups', [])
+        purge_groups = args.get('purge_groups', False)
         wanted_state = args.get('state', 'present')
 
         if uid is None:
@@ -132,6 +146,7 @@ class ActionModule(ActionBase):
         if password is None:
             raise AnsibleActionFail('password cannot be empty for dcos_iam_user')
 
+        select_cluster(task_vars)
         ensure_dcos()
         ensure_dcos_security()
 
@@ -142,19 +157,21 @@ class ActionModule(ActionBase):
             display.vvv(
                 "DC/OS IAM user {} already in desired state {}".format(uid, wanted_state))
 
-            if wanted_state == "present":
-                user_update(uid, groups)
-
             result['changed'] = False
+
+            if wanted_state == "present":
+                result['changed'] = user_update(uid, groups, purge_groups)
         else:
             display.vvv("DC/OS: IAM user {} not in desired state {}".format(uid, wanted_state))
 
             if wanted_state != 'absent':
                 user_create(uid, password, description)
-                user_update(uid, groups)
+                update_snapshot('iam-users', uid, {'description': description})
+                user_update(uid, groups, purge_groups)
 
             else:
                 user_delete(uid)
+                update_snapshot('iam-users', uid)
 
             result['changed'] = True
 
@@ -6,9 +6,9 @@ Uses the Ansible host to connect directly to DC/OS.
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import copy
 import json
 import subprocess
-import tempfile
 import time
 import os
 import sys
@@ -19,7 +19,16 @@ from ansible.errors import AnsibleActionFail
 # to prevent duplicating code, make sure we can import common stuff
 sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
-from action_plugins.common import ensure_dcos, run_command, _dcos_path
+from action_plugins.common import (
+    ensure_dcos,
+    select_cluster,
+    run_command,
+    _dcos_path,
+    dcos_api,
+    deployment_id,
+    wait_for_deployment,
+    diff_config
+)
 
 try:
     from __main__ import display
@@ -27,82 +36,151 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+def get_app(app_id):
+    """Get the current definition of an app, or None if it does not exist."""
+    api = dcos_api()
+    if api is not None:
+        r = api.find('/service/marathon/v2/apps/' + app_id.strip('/'))
+        return r['app'] if r is not None else None
+
+    try:
+        r = subprocess.check_output(
+            ['dcos', 'marathon', 'app', 'show', app_id],
+            env=_dcos_path(), stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        return None
+    return json.loads(r)
+
+# Values Marathon fills in for top-level fields left out of an app definition.
+# Used to notice fields that were dropped from the wanted options.
+MARATHON_APP_DEFAULTS = {
+    'instances': 1,
+    'cpus': 1,
+    'mem': 128,
+    'disk': 0,
+    'gpus': 0,
+    'constraints': [],
+    'labels': {},
+    'env': {},
+    'secrets': {},
+    'fetch': [],
+    'dependencies': [],
+    'healthChecks': [],
+    'readinessChecks': [],
+}
+
+# Docker networks of the legacy app format and the network modes Marathon stores instead.
+LEGACY_NETWORK_MODES = {
+    'BRIDGE': 'container/bridge',
+    'HOST': 'host',
+    'USER': 'container',
+}
+
+def normalize_app(options):
+    """Rewrite legacy app fields the way Marathon stores them.
+
+    Marathon converts ``uris``, ``ipAddress``, ``container.docker.network`` and
+    ``container.docker.portMappings`` when it saves an app, so they would
+    never match the current app otherwise. Only used for comparing, the
+    options are sent as given.
+    """
+    options = copy.deepcopy(options)
+
+    uris = options.pop('uris', None)
+    if uris and 'fetch' not in options:
+        options['fetch'] = [{'uri': u} for u in uris]
+
+    ip_address = options.pop('ipAddress', None) or {}
+    container = options.get('container') or {}
+    docker = container.get('docker') or {}
+    if 'portMappings' in docker:
+        container.setdefault('portMappings', docker.pop('portMappings'))
+    network = docker.pop('network', None)
+    if network in LEGACY_NETWORK_MODES and 'networks' not in options:
+        mode = {'mode': LEGACY_NETWORK_MODES[network]}
+        if network == 'USER' and ip_address.get('networkName'):
+            mode['name'] = ip_address['networkName']
+        options['networks'] = [mode]
+    return options
+
+def dropped_fields(options, app):
+    """Get the defaults of fields that were dropped from the wanted options.
+
+    Marathon keeps fields that are left out of an update, so these have to be
+    sent explicitly to remove them from the current app.
+    """
+    options = normalize_app(options)
+    return {k: default for k, default in MARATHON_APP_DEFAULTS.items()
+            if k not in options and k in app and diff_config(app[k], default)}
+
+def app_diff(options, app):
+    """Get the settings in which a current app differs from the wanted options."""
+    diffs = diff_config(normalize_app(options), app)
+    for k, default in dropped_fields(options, app).items():
+        diffs.extend(diff_config(app[k], default, '/' + k))
+    return diffs
+
 def get_app_state(app_id):
     """Get the current state of an app."""
-    r = subprocess.check_output(['dcos', 'marathon', 'app', 'list', '--json' ], env=_dcos_path())
-    apps = json.loads(r)
-
     display.vvv('looking for app_id {}'.format(app_id))
 
     state = 'absent'
-    for a in apps:
-        try:
-            if app_id == a['id']:
-                state = 'present'
-                display.vvv('found app: {}'.format(app_id))
-
-        except KeyError:
-         continue
+    if get_app(app_id) is not None:
+        state = 'present'
+        display.vvv('found app: {}'.format(app_id))
     return state
 
 def app_create(app_id, options):
     """Deploy an app via Marathon"""
     display.vvv("DC/OS: Marathon create app {}".format(app_id))
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
-
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
+    api = dcos_api()
+    if api is not None:
+        return deployment_id(api.post('/service/marathon/v2/apps', options))
 
-        display.vvv(subprocess.check_output(
-        ['cat', f.name]).decode())
+    cmd = [
+        'dcos',
+        'marathon',
+        'app',
+        'add'
+    ]
+    return deployment_id(run_command(cmd, 'add app', stop_on_error=True, input=options))
 
-        cmd = [
-            'dcos',
-            'marathon',
-            'app',
-            'add',
-            f.name
-        ]
-        run_command(cmd, 'add app', stop_on_error=True)
 
+def app_update(app_id, options, current_app=None):
+    """Update an app via Marathon
 
-def app_update(app_id, options):
-    """Update an app via Marathon"""
+    :param current_app: the current definition, to reset the fields that
+                        were dropped from the options to their defaults
+    """
     display.vvv("DC/OS: Marathon update app {}".format(app_id))
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
-
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
+    if current_app is not None:
+        options = dict(dropped_fields(options, current_app), **options)
 
-        cmd = [
-            'dcos',
-            'marathon',
-            'app',
-            'update',
-            '--force',
-            app_id
-        ]
+    api = dcos_api()
+    if api is not None:
+        return deployment_id(api.put('/service/marathon/v2/apps/{}?force=true'.format(
+            app_id.strip('/')), options))
 
-        from subprocess import Popen, PIPE
-
-        p = Popen(cmd, env=_dcos_path(), stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate(json.dumps(options).encode())
-
-        display.vvv("stdout {}".format(stdout))
-        display.vvv("stderr {}".format(stderr))
+    cmd = [
+        'dcos',
+        'marathon',
+        'app',
+        'update',
+        '--force',
+        app_id
+    ]
+    return deployment_id(run_command(cmd, 'update app', stop_on_error=True, input=options))
 
 def app_remove(app_id):
     """Remove an app via Marathon"""
     display.vvv("DC/OS: Marathon remove app {}".format(app_id))
 
+    api = dcos_api()
+    if api is not None:
+        return deployment_id(api.delete('/service/marathon/v2/apps/' + app_id.strip('/')))
+
     cmd = [
         'dcos',
         'marathon',
@@ -110,7 +188,7 @@ def app_remove(app_id):
         'remove',
         '/' + app_id,
     ]
-    run_command(cmd, 'remove app', stop_on_error=True)
+    return deployment_id(run_command(cmd, 'remove app', stop_on_error=True))
 
 class ActionModule(ActionBase):
     def run(self, tmp=None, task_vars=None):
@@ -133,9 +211,17 @@ class ActionModule(ActionBase):
         options = args.get('options') or {}
         options['id']= app_id
 
+        # wait for the deployment to finish, at most wait_timeout seconds
+        wait = args.get('wait', False)
+        wait_timeout = int(args.get('wait_timeout', 600))
+        # False until a deployment is started, None when its id is unknown
+        deployment = False
+
+        select_cluster(task_vars)
         ensure_dcos()
 
-        current_state = get_app_state(app_id)
+        current_app = get_app(app_id)
+        current_state = 'present' if current_app is not None else 'absent'
         wanted_state = state
 
         if current_state == wanted_state:
@@ -143,18 +229,31 @@ class ActionModule(ActionBase):
             display.vvv(
                 "Marathon app {} already in desired state {}".format(app_id, wanted_state))
 
-            if wanted_state == "present":
-                app_update(app_id, options)
-
             result['changed'] = False
+
+            if wanted_state == "present":
+                diffs = app_diff(options, current_app)
+                if diffs:
+                    display.vvv("Marathon app {} differs in {}".format(
+                        app_id, ', '.join(diffs)))
+                    deployment = app_update(app_id, options, current_app)
+                    result['changed'] = True
         else:
             display.vvv("Marathon app {} not in desired state {}".format(app_id, wanted_state))
 
             if wanted_state != 'absent':
-                app_create(app_id, options)
+                deployment = app_create(app_id, options)
             else:
-                app_remove(app_id)
+                deployment = app_remove(app_id)
 
             result['changed'] = True
 
+        if deployment is not False:
+            result['deployment_id'] = deployment
+            # lets dcos_deployment_wait wait when the id is unknown
+            result['app_id'] = app_id
+            if wait:
+                result['deployment_time'] = wait_for_deployment(
+                    deployment or app_id, wait_timeout, 'app ' + app_id)
+
         return result
@@ -8,7 +8,6 @@ __metaclass__ = type
 
 import json
 import subprocess
-import tempfile
 import time
 import os
 import sys
@@ -19,7 +18,15 @@ from ansible.errors import AnsibleActionFail
 # to prevent duplicating code, make sure we can import common stuff
 sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
-from action_plugins.common import ensure_dcos, run_command, _dcos_path
+from action_plugins.common import (
+    ensure_dcos,
+    select_cluster,
+    run_command,
+    _dcos_path,
+    dcos_api,
+    deployment_id,
+    wait_for_deployment
+)
 
 try:
     from __main__ import display
@@ -27,82 +34,74 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+def get_group(group_id):
+    """Get the current definition of a group, or None if it does not exist."""
+    api = dcos_api()
+    if api is not None:
+        return api.find('/service/marathon/v2/groups/' + group_id.strip('/'))
+
+    try:
+        r = subprocess.check_output(
+            ['dcos', 'marathon', 'group', 'show', group_id],
+            env=_dcos_path(), stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        return None
+    return json.loads(r)
+
 def get_group_state(group_id):
     """Get the current state of an group."""
-    r = subprocess.check_output(['dcos', 'marathon', 'group', 'list', '--json' ], env=_dcos_path())
-    groups = json.loads(r)
-
     display.vvv('looking for group_id {}'.format(group_id))
 
     state = 'absent'
-    for a in groups:
-        try:
-            if group_id == a['id']:
-                state = 'present'
-                display.vvv('found group: {}'.format(group_id))
-
-        except KeyError:
-         continue
+    if get_group(group_id) is not None:
+        state = 'present'
+        display.vvv('found group: {}'.format(group_id))
     return state
 
 def group_create(group_id, options):
     """Deploy an group via Marathon"""
     display.vvv("DC/OS: Marathon create group {}".format(group_id))
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
+    api = dcos_api()
+    if api is not None:
+        return deployment_id(api.post('/service/marathon/v2/groups', options))
 
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
-
-        display.vvv(subprocess.check_output(
-        ['cat', f.name]).decode())
-
-        cmd = [
-            'dcos',
-            'marathon',
-            'group',
-            'add',
-            f.name
-        ]
-        run_command(cmd, 'add group', stop_on_error=True)
+    cmd = [
+        'dcos',
+        'marathon',
+        'group',
+        'add'
+    ]
+    return deployment_id(run_command(cmd, 'add group', stop_on_error=True, input=options))
 
 
 def group_update(group_id, options):
     """Update an group via Marathon"""
     display.vvv("DC/OS: Marathon update group {}".format(group_id))
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
-
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
+    api = dcos_api()
+    if api is not None:
+        return deployment_id(api.put('/service/marathon/v2/groups/{}?force=true'.format(
+            group_id.strip('/')), options))
 
-        cmd = [
-            'dcos',
-            'marathon',
-            'group',
-            'update',
-            '--force',
-            group_id
-        ]
-
-        from subprocess import Popen, PIPE
-
-        p = Popen(cmd, env=_dcos_path(), stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate(json.dumps(options).encode())
-
-        display.vvv("stdout {}".format(stdout))
-        display.vvv("stderr {}".format(stderr))
+    cmd = [
+        'dcos',
+        'marathon',
+        'group',
+        'update',
+        '--force',
+        group_id
+    ]
+    return deployment_id(run_command(cmd, 'update group', stop_on_error=True, input=options))
 
 def group_remove(group_id):
     """Remove an group via Marathon"""
     display.vvv("DC/OS: Marathon remove group {}".format(group_id))
 
+    api = dcos_api()
+    if api is not None:
+        return deployment_id(api.delete('/service/marathon/v2/groups/' + group_id.strip('/')))
+
     cmd = [
         'dcos',
         'marathon',
@@ -110,7 +109,7 @@ def group_remove(group_id):
         'remove',
         '/' + group_id,
     ]
-    run_command(cmd, 'remove group', stop_on_error=True)
+    return deployment_id(run_command(cmd, 'remove group', stop_on_error=True))
 
 class ActionModule(ActionBase):
     def run(self, tmp=None, task_vars=None):
@@ -133,6 +132,13 @@ class ActionModule(ActionBase):
         options = args.get('options') or {}
         options['id']= group_id
 
+        # wait for the deployment to finish, at most wait_timeout seconds
+        wait = args.get('wait', False)
+        wait_timeout = int(args.get('wait_timeout', 600))
+        # False until a deployment is started, None when its id is unknown
+        deployment = False
+
+        select_cluster(task_vars)
         ensure_dcos()
 
         current_state = get_group_state(group_id)
@@ -144,17 +150,25 @@ class ActionModule(ActionBase):
                 "Marathon group {} already in desired state {}".format(group_id, wanted_state))
 
             if wanted_state == "present":
-                group_update(group_id, options)
+                deployment = group_update(group_id, options)
 
             result['changed'] = False
         else:
             display.vvv("Marathon group {} not in desired state {}".format(group_id, wanted_state))
 
             if wanted_state != 'absent':
-                group_create(group_id, options)
+                deployment = group_create(group_id, options)
             else:
-                group_remove(group_id)
+                deployment = group_remove(group_id)
 
             result['changed'] = True
 
+        if deployment is not False:
+            result['deployment_id'] = deployment
+            # lets dcos_deployment_wait wait when the id is unknown
+            result['group_id'] = group_id
+            if wait:
+                result['deployment_time'] = wait_for_deployment(
+                    deployment or group_id, wait_timeout, 'group ' + group_id)
+
         return result
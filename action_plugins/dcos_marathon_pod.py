@@ -8,7 +8,6 @@ __metaclass__ = type
 
 import json
 import subprocess
-import tempfile
 import time
 import os
 import sys
@@ -19,7 +18,15 @@ from ansible.errors import AnsibleActionFail
 # to prevent duplicating code, make sure we can import common stuff
 sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
-from action_plugins.common import ensure_dcos, run_command, _dcos_path
+from action_plugins.common import (
+    ensure_dcos,
+    select_cluster,
+    run_command,
+    _dcos_path,
+    dcos_api,
+    deployment_id,
+    wait_for_deployment
+)
 
 try:
     from __main__ import display
@@ -27,82 +34,82 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+def get_pod(pod_id):
+    """Get the current definition of a pod, or None if it does not exist."""
+    api = dcos_api()
+    if api is not None:
+        return api.find('/service/marathon/v2/pods/' + pod_id.strip('/'))
+
+    try:
+        r = subprocess.check_output(
+            ['dcos', 'marathon', 'pod', 'show', pod_id],
+            env=_dcos_path(), stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        return None
+    return json.loads(r)
+
 def get_pod_state(pod_id):
     """Get the current state of an pod."""
-    r = subprocess.check_output(['dcos', 'marathon', 'pod', 'list', '--json' ], env=_dcos_path())
-    pods = json.loads(r)
-
     display.vvv('looking for pod_id {}'.format(pod_id))
 
     state = 'absent'
-    for a in pods:
-        try:
-            if pod_id == a['id']:
-                state = 'present'
-                display.vvv('found pod: {}'.format(pod_id))
-
-        except KeyError:
-         continue
+    if get_pod(pod_id) is not None:
+        state = 'present'
+        display.vvv('found pod: {}'.format(pod_id))
     return state
 
 def pod_create(pod_id, options):
     """Deploy an pod via Marathon"""
     display.vvv("DC/OS: Marathon create pod {}".format(pod_id))
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
+    api = dcos_api()
+    if api is not None:
+        headers = {}
+        r = api.post('/service/marathon/v2/pods', options,
+                     response_headers=headers)
+        return deployment_id(r, headers)
 
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
-
-        display.vvv(subprocess.check_output(
-        ['cat', f.name]).decode())
-
-        cmd = [
-            'dcos',
-            'marathon',
-            'pod',
-            'add',
-            f.name
-        ]
-        run_command(cmd, 'add pod', stop_on_error=True)
+    cmd = [
+        'dcos',
+        'marathon',
+        'pod',
+        'add'
+    ]
+    return deployment_id(run_command(cmd, 'add pod', stop_on_error=True, input=options))
 
 
 def pod_update(pod_id, options):
     """Update an pod via Marathon"""
     display.vvv("DC/OS: Marathon update pod {}".format(pod_id))
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
-
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
+    api = dcos_api()
+    if api is not None:
+        headers = {}
+        r = api.put('/service/marathon/v2/pods/{}?force=true'.format(
+            pod_id.strip('/')), options, response_headers=headers)
+        return deployment_id(r, headers)
 
-        cmd = [
-            'dcos',
-            'marathon',
-            'pod',
-            'update',
-            '--force',
-            pod_id
-        ]
-
-        from subprocess import Popen, PIPE
-
-        p = Popen(cmd, env=_dcos_path(), stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate(json.dumps(options).encode())
-
-        display.vvv("stdout {}".format(stdout))
-        display.vvv("stderr {}".format(stderr))
+    cmd = [
+        'dcos',
+        'marathon',
+        'pod',
+        'update',
+        '--force',
+        pod_id
+    ]
+    return deployment_id(run_command(cmd, 'update pod', stop_on_error=True, input=options))
 
 def pod_remove(pod_id):
     """Remove an pod via Marathon"""
     display.vvv("DC/OS: Marathon remove pod {}".format(pod_id))
 
+    api = dcos_api()
+    if api is not None:
+        headers = {}
+        r = api.delete('/service/marathon/v2/pods/' + pod_id.strip('/'),
+                       response_headers=headers)
+        return deployment_id(r, headers)
+
     cmd = [
         'dcos',
         'marathon',
@@ -110,7 +117,7 @@ def pod_remove(pod_id):
         'remove',
         '/' + pod_id,
     ]
-    run_command(cmd, 'remove pod', stop_on_error=True)
+    return deployment_id(run_command(cmd, 'remove pod', stop_on_error=True))
 
 class ActionModule(ActionBase):
     def run(self, tmp=None, task_vars=None):
@@ -133,6 +140,13 @@ class ActionModule(ActionBase):
         options = args.get('options') or {}
         options['id']= pod_id
 
+        # wait for the deployment to finish, at most wait_timeout seconds
+        wait = args.get('wait', False)
+        wait_timeout = int(args.get('wait_timeout', 600))
+        # False until a deployment is started, None when its id is unknown
+        deployment = False
+
+        select_cluster(task_vars)
         ensure_dcos()
 
         current_state = get_pod_state(pod_id)
@@ -144,17 +158,25 @@ class ActionModule(ActionBase):
                 "Marathon pod {} already in desired state {}".format(pod_id, wanted_state))
 
             if wanted_state == "present":
-                pod_update(pod_id, options)
+                deployment = pod_update(pod_id, options)
 
             result['changed'] = False
         else:
             display.vvv("Marathon pod {} not in desired state {}".format(pod_id, wanted_state))
 
             if wanted_state != 'absent':
-                pod_create(pod_id, options)
+                deployment = pod_create(pod_id, options)
             else:
-                pod_remove(pod_id)
+                deployment = pod_remove(pod_id)
 
             result['changed'] = True
 
+        if deployment is not False:
+            result['deployment_id'] = deployment
+            # lets dcos_deployment_wait wait when the id is unknown
+            result['pod_id'] = pod_id
+            if wait:
+                result['deployment_time'] = wait_for_deployment(
+                    deployment or pod_id, wait_timeout, 'pod ' + pod_id)
+
         return result
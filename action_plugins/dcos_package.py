@@ -6,9 +6,9 @@ Uses the Ansible host to connect directly to DC/OS.
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import hashlib
 import json
 import subprocess
-import tempfile
 import time
 import os
 import sys
@@ -19,8 +19,16 @@ from ansible.errors import AnsibleActionFail
 # to prevent duplicating code, make sure we can import common stuff
 sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
-from action_plugins.common import ensure_dcos, run_command, _dcos_path
-from action_plugins.dcos_marathon import app_update
+from action_plugins.common import (
+    ensure_dcos,
+    select_cluster,
+    run_command,
+    _dcos_path,
+    dcos_api,
+    get_cluster_config,
+    persistent_cache
+)
+from action_plugins.dcos_marathon import app_update, app_diff, get_app
 try:
     from __main__ import display
 except ImportError:
@@ -29,11 +37,22 @@ except ImportError:
 
 def get_current_version(package, app_id):
     """Get the current version of an installed package."""
+    display.vvv('looking for package {} app_id {}'.format(package, app_id))
+
+    api = dcos_api()
+    if api is not None:
+        r = api.cosmos('list', {'packageName': package, 'appId': '/' + app_id})
+        v = None
+        for p in r['packages']:
+            definition = p['packageInformation']['packageDefinition']
+            if definition['name'] == package and p['appId'] == '/' + app_id:
+                v = definition['version']
+        display.vvv('{} current version: {}'.format(package, v))
+        return v
+
     r = subprocess.check_output(['dcos', 'package', 'list', '--json', '--app-id=/'+app_id ], env=_dcos_path())
     packages = json.loads(r)
 
-    display.vvv('looking for package {} app_id {}'.format(package, app_id))
-
     v = None
     for p in packages:
         try:
@@ -55,59 +74,89 @@ def install_package(package, version, options):
     display.vvv("DC/OS: installing package {} version {}".format(
         package, version))
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
-
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
-
-        display.vvv(subprocess.check_output(
-        ['cat', f.name]).decode())
+    api = dcos_api()
+    if api is not None:
+        api.cosmos('install', {
+            'packageName': package,
+            'packageVersion': version,
+            'options': options,
+        }, response_version='v2')
+        return
 
+    # the options are passed on stdin to avoid a temporary file
+    cmd = [
+        'dcos',
+        'package',
+        'install',
+        package,
+        '--yes',
+        '--package-version',
+        version,
+        '--options',
+        '/dev/stdin'
+    ]
+    run_command(cmd, 'install package', stop_on_error=True, input=options)
+
+# rendered apps only depend on the package version and options,
+# refresh them now and then in case a repository republished a version
+RENDER_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+def render_package(package, app_id, version, options):
+    """Render the Marathon app of a package, cached on disk between runs."""
+    options_hash = hashlib.sha256(
+        json.dumps(options, sort_keys=True).encode()).hexdigest()
+    cluster = get_cluster_config().get('cluster_id')
+    key = 'render:{}:{}:{}:{}:{}'.format(
+        cluster, package, version, app_id, options_hash)
+
+    cache = persistent_cache()
+    app = cache.get(key, max_age=RENDER_CACHE_MAX_AGE)
+    if app is not None:
+        display.vvv('DC/OS: using cached render of package {}'.format(package))
+        return app
+
+    api = dcos_api()
+    if api is not None:
+        app = api.cosmos('render', {
+            'packageName': package,
+            'packageVersion': version,
+            'options': options,
+            'appId': '/' + app_id,
+        })['marathonJson']
+    else:
         cmd = [
             'dcos',
             'package',
-            'install',
+            'describe',
             package,
-            '--yes',
+            '--options',
+            '/dev/stdin',
             '--package-version',
             version,
-            '--options',
-            f.name
+            '--render',
+            '--app',
         ]
-        run_command(cmd, 'install package', stop_on_error=True)
+        app = json.loads(run_command(cmd, 'render package', stop_on_error=True,
+                                     input=options, stderr=subprocess.PIPE))
 
-def update_package(package, app_id, version, options):
-    """Update a Universe package on DC/OS."""
-    display.vvv("DC/OS: updating package {} version {}".format(
-        package, version))
+    cache.set(key, app)
+    return app
 
-    # create a temporary file for the options json file
-    with tempfile.NamedTemporaryFile('w+') as f:
-        json.dump(options, f)
+def update_package(package, app_id, version, options):
+    """Update a Universe package on DC/OS.
 
-        # force write the file to disk to make sure subcommand can read it
-        f.flush()
-        os.fsync(f)
+    :return: whether the Marathon app of the package had to be updated
+    """
+    app = render_package(package, app_id, version, options)
 
-        display.vvv(subprocess.check_output(
-        ['cat', f.name]).decode())
+    current_app = get_app('/' + app_id)
+    if current_app is not None and not app_diff(app, current_app):
+        display.vvv("DC/OS: package {} is up to date".format(package))
+        return False
 
-        r = subprocess.check_output([
-            'dcos',
-            'package',
-            'describe',
-            package,
-            '--options',
-            f.name,
-            '--package-version',
-            version,
-            '--render',
-            '--app',
-            ], env=_dcos_path())
-        app_update(app_id, json.loads(r))
+    display.vvv("DC/OS: updating package {} version {}".format(
+        package, version))
+    app_update(app_id, app, current_app)
 
     # workaround: install cli to refresh dcos package list
     cmd = [
@@ -121,10 +170,16 @@ def update_package(package, app_id, version, options):
         '--cli'
     ]
     run_command(cmd, 'install cli', stop_on_error=True)
+    return True
 
 def uninstall_package(package, app_id):
     display.vvv("DC/OS: uninstalling package {}".format(package))
 
+    api = dcos_api()
+    if api is not None:
+        api.cosmos('uninstall', {'packageName': package, 'appId': '/' + app_id})
+        return
+
     cmd = [
         'dcos',
         'package',
@@ -167,6 +222,7 @@ class ActionModule(ActionBase):
         except KeyError:
             options['service'] = {'name': app_id }
 
+        select_cluster(task_vars)
         ensure_dcos()
 
         current_version = get_current_version(package_name, app_id)
@@ -176,10 +232,11 @@ class ActionModule(ActionBase):
             display.vvv(
                 "Package {} already in desired state".format(package_name))
             
-            if state == "present":
-                update_package(package_name, app_id, wanted_version, options)
-
             result['changed'] = False
+
+            if state == "present":
+                result['changed'] = update_package(
+                    package_name, app_id, wanted_version, options)
         else:
             display.vvv("Package {} not in desired state".format(package_name))
             if wanted_version is not None:
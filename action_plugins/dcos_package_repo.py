@@ -9,7 +9,6 @@ __metaclass__ = type
 import json
 import subprocess
 import tempfile
-import time
 import os
 import sys
 
@@ -19,7 +18,15 @@ from ansible.errors import AnsibleActionFail
 # to prevent duplicating code, make sure we can import common stuff
 sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
-from action_plugins.common import ensure_dcos, run_command, _dcos_path
+from action_plugins.common import (
+    ensure_dcos,
+    select_cluster,
+    run_command,
+    _dcos_path,
+    dcos_api,
+    get_snapshot,
+    invalidate_snapshot
+)
 
 try:
     from __main__ import display
@@ -27,30 +34,41 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+def _list_repos():
+    """List all package repositories indexed by name."""
+    api = dcos_api()
+    if api is not None:
+        repos = api.cosmos('repository/list', {})['repositories']
+    else:
+        r = subprocess.check_output([
+            'dcos',
+            'package',
+            'repo',
+            'list',
+            '--json'
+            ],
+            env=_dcos_path()
+        )
+        repos = json.loads(r)['repositories']
+
+    indexed = {}
+    for i, n in enumerate(repos):
+        if 'name' in n:
+            indexed[n['name']] = dict(n, index=i)
+    return indexed
+
+def get_repos():
+    """Get all package repositories indexed by name, including their index."""
+    return get_snapshot('package-repos', _list_repos)
+
 def get_repo_state(name):
     """Get the current state of a repo"""
-
-    r = subprocess.check_output([
-        'dcos',
-        'package',
-        'repo',
-        'list',
-        '--json'
-        ],
-        env=_dcos_path()
-    )
-    repos = json.loads(r)['repositories']
-
     display.vvv('looking for repo {}'.format(name))
 
     state = 'absent'
-    for n in repos:
-        try:
-            if n['name'] == name:
-                state = 'present'
-                display.vvv('found repo name: {}'.format(n['name']))
-        except KeyError:
-            continue
+    if name in get_repos():
+        state = 'present'
+        display.vvv('found repo name: {}'.format(name))
 
     return state
 
@@ -58,6 +76,12 @@ def repo_add(name, url, index):
     """Create a repo"""
     display.vvv("DC/OS: create repo {}".format(name))
 
+    api = dcos_api()
+    if api is not None:
+        api.cosmos('repository/add', {'name': name, 'uri': url, 'index': int(index)})
+        invalidate_snapshot('package-repos')
+        return
+
     quotes = '\"'
 
     cmd = [
@@ -71,22 +95,41 @@ def repo_add(name, url, index):
         url,
     ]
     run_command(cmd, 'add repo', stop_on_error=True)
+    invalidate_snapshot('package-repos')
 
 def repo_update(name, url, index):
-    """Update a repo"""
+    """Update a repo if its url or position differs
+
+    :return: whether the repo had to be changed
+    """
+    repos = get_repos()
+    current = repos[name]
+
+    # an index past the end of the list puts the repo last
+    position = min(int(index), len(repos) - 1)
+    if current['uri'] == url and current['index'] == position:
+        display.vvv("DC/OS: repo {} is up to date".format(name))
+        return False
+
     display.vvv("DC/OS: updating repo {}".format(
         name))
 
+    # Cosmos cannot change a repo in place, removal is synchronous so the
+    # repo can be added again straight away
     repo_remove(name)
-    while get_repo_state(name) != 'absent':
-        time.sleep(1)
-
     repo_add(name, url, index)
+    return True
 
 def repo_remove(name):
     """Delete a repo"""
     display.vvv("DC/OS: remove repo {}".format(name))
 
+    api = dcos_api()
+    if api is not None:
+        api.cosmos('repository/delete', {'name': name})
+        invalidate_snapshot('package-repos')
+        return
+
     cmd = [
         'dcos',
         'package',
@@ -95,6 +138,7 @@ def repo_remove(name):
         name,
     ]
     run_command(cmd, 'remove repo', stop_on_error=True)
+    invalidate_snapshot('package-repos')
 
 class ActionModule(ActionBase):
     def run(self, tmp=None, task_vars=None):
@@ -120,6 +164,7 @@ class ActionModule(ActionBase):
         if url is None:
             raise AnsibleActionFail('url cannot be empty for dcos_package_repo')
 
+        select_cluster(task_vars)
         ensure_dcos()
 
         current_state = get_repo_state(name)
@@ -129,10 +174,10 @@ class ActionModule(ActionBase):
             display.vvv(
                 "DC/OS: Repo {} already in desired state".format(name))
             
-            if wanted_state == "present":
-                repo_update(name, url, index)
-
             result['changed'] = False
+
+            if wanted_state == "present":
+                result['changed'] = repo_update(name, url, index)
         else:
 
             display.vvv("DC/OS: Repo {} not in desired state".format(name))
@@ -0,0 +1,125 @@
+"""
+Action plugin to configure a DC/OS cluster.
+Uses the Ansible host to connect directly to DC/OS.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+
+from ansible.plugins.action import ActionBase
+from ansible.errors import AnsibleActionFail
+
+# to prevent duplicating code, make sure we can import common stuff
+sys.path.append(os.getcwd())
+sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
+from action_plugins.common import ensure_dcos, select_cluster
+from action_plugins.dcos_package_repo import (
+    get_repos,
+    repo_add,
+    repo_remove
+)
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+def _common_subsequence(a, b):
+    """Get the names in the longest common subsequence of two name lists."""
+    lengths = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in range(len(a) - 1, -1, -1):
+        for j in range(len(b) - 1, -1, -1):
+            if a[i] == b[j]:
+                lengths[i][j] = lengths[i + 1][j + 1] + 1
+            else:
+                lengths[i][j] = max(lengths[i + 1][j], lengths[i][j + 1])
+
+    common = set()
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            common.add(a[i])
+            i += 1
+            j += 1
+        elif lengths[i + 1][j] >= lengths[i][j + 1]:
+            i += 1
+        else:
+            j += 1
+    return common
+
+def plan_repos(current, wanted, purge=False):
+    """Plan the removals and additions that turn the current repo list into the wanted one.
+
+    The wanted repos end up first, in the given order, followed by the other
+    current repos unless they are purged. The repos that already are in the
+    right relative order are kept, so the number of operations is minimal.
+
+    :param current: list of (name, url) tuples in repository order
+    :param wanted: list of (name, url) tuples in the wanted order
+    :return: tuple of names to remove and (name, url, index) tuples to add
+    """
+    wanted_names = set(name for name, _ in wanted)
+    desired = list(wanted)
+    if not purge:
+        desired.extend(r for r in current if r[0] not in wanted_names)
+
+    urls = dict(desired)
+    remaining = [name for name, url in current if urls.get(name) == url]
+    keep = _common_subsequence(remaining, [name for name, _ in desired])
+
+    remove = [name for name, _ in current if name not in keep]
+    add = [(name, url, i) for i, (name, url) in enumerate(desired)
+           if name not in keep]
+    return remove, add
+
+class ActionModule(ActionBase):
+    def run(self, tmp=None, task_vars=None):
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+
+        if self._play_context.check_mode:
+            # in --check mode, always skip this module execution
+            result['skipped'] = True
+            result['msg'] = 'The dcos task does not support check mode'
+            return result
+
+        args = self._task.args
+        repositories = args.get('repositories')
+        purge = args.get('purge', False)
+
+        if repositories is None:
+            raise AnsibleActionFail('repositories cannot be empty for dcos_package_repos')
+
+        wanted = []
+        for r in repositories:
+            if r.get('name') is None or r.get('url') is None:
+                raise AnsibleActionFail(
+                    'every repository of dcos_package_repos needs a name and url')
+            wanted.append((r['name'], r['url']))
+
+        select_cluster(task_vars)
+        ensure_dcos()
+
+        current = [(r['name'], r['uri']) for r in
+                   sorted(get_repos().values(), key=lambda r: r['index'])]
+        remove, add = plan_repos(current, wanted, purge)
+
+        # removals first so re-added repos do not clash with their old entry
+        for name in remove:
+            repo_remove(name)
+        for name, url, index in add:
+            repo_add(name, url, index)
+
+        if remove or add:
+            display.vvv("DC/OS: repos removed {} added {}".format(
+                remove, [name for name, _, _ in add]))
+
+        result['changed'] = len(remove) + len(add) > 0
+        result['removed'] = remove
+        result['added'] = [name for name, _, _ in add]
+        return result
@@ -13,6 +13,8 @@ import time
 import os
 import sys
 
+from functools import partial
+
 from ansible.plugins.action import ActionBase
 from ansible.errors import AnsibleActionFail
 
@@ -21,8 +23,13 @@ sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
 from action_plugins.common import (
     ensure_dcos,
+    select_cluster,
     run_command,
-    _dcos_path
+    _dcos_path,
+    dcos_api,
+    get_snapshot,
+    update_snapshot,
+    run_concurrently
 )
 
 try:
@@ -31,37 +38,93 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+def _list_quotas():
+    """List all quotas indexed by role."""
+    api = dcos_api()
+    if api is not None:
+        r = api.post('/mesos/api/v1', {'type': 'GET_QUOTA'})
+        quotas = r['get_quota']['status'].get('configs', [])
+    else:
+        r = subprocess.check_output([
+            'dcos',
+            'quota',
+            'list',
+            '--json'
+            ],
+            env=_dcos_path()
+        )
+        quotas = json.loads(r) or []
+    return dict((q['role'], q) for q in quotas if 'role' in q)
+
 def get_quota_state(gid):
     """Get the current state of a quota."""
-
-    r = subprocess.check_output([
-        'dcos',
-        'quota',
-        'list',
-        '--json'
-        ],
-        env=_dcos_path()
-    )
-    quotas = json.loads(r)
-
     display.vvv('looking for gid {}'.format(gid))
 
     state = 'absent'
-    if quotas!=None:
-        for q in quotas:
-            try:
-                if gid == q['role']:
-                    state = 'present'
-                    display.vvv('found pool: {}'.format(gid))
-
-            except KeyError:
-                continue
+    if gid in get_snapshot('quotas', _list_quotas):
+        state = 'present'
+        display.vvv('found quota: {}'.format(gid))
     return state
 
+def _quota_limits(quota):
+    """Get the limits of a listed quota as a dict of resource to value."""
+    limits = quota.get('limits') or quota.get('limit') or {}
+    return dict((k, v.get('value') if isinstance(v, dict) else v)
+                for k, v in limits.items())
+
+def _quota_config(gid, cpu, mem, disk, gpu, current=None):
+    """Build a Mesos quota config for the operator API.
+
+    Limits that are not given are kept from the current quota, like the cli does.
+    """
+    limits = {}
+    if current is not None:
+        for name, value in _quota_limits(current).items():
+            limits[name] = {'value': float(value)}
+    for name, value in (('cpus', cpu), ('mem', mem), ('disk', disk), ('gpus', gpu)):
+        if value is not None:
+            limits[name] = {'value': float(value)}
+    return {'role': gid, 'limits': limits}
+
+def quota_differs(quota, cpu, mem, disk, gpu):
+    """Check whether the given limits differ from those of a current quota."""
+    current = _quota_limits(quota)
+    for name, value in (('cpus', cpu), ('mem', mem), ('disk', disk), ('gpus', gpu)):
+        if value is None:
+            continue
+        if current.get(name) is None or float(current[name]) != float(value):
+            return True
+    return False
+
+def plan_quota(quotas, gid, cpu, mem, disk, gpu, state):
+    """Get the change needed for the quota of a role.
+
+    :param quotas: current quotas indexed by role
+    :return: 'create', 'update', 'delete' or None when nothing has to change
+    """
+    if state == 'absent':
+        return 'delete' if gid in quotas else None
+    if gid not in quotas:
+        return 'create'
+    if quota_differs(quotas[gid], cpu, mem, disk, gpu):
+        return 'update'
+    return None
+
+def _quota_api_update(api, configs):
+    api.post('/mesos/api/v1', {
+        'type': 'UPDATE_QUOTA',
+        'update_quota': {'force': False, 'quota_configs': configs},
+    })
+
 def quota_create(gid, cpu, mem, disk, gpu):
     """Create a quota"""
     display.vvv("DC/OS: create quota {}".format(gid))
 
+    api = dcos_api()
+    if api is not None:
+        _quota_api_update(api, [_quota_config(gid, cpu, mem, disk, gpu)])
+        return
+
     cmd = [
         'dcos',
         'quota',
@@ -84,6 +147,11 @@ def quota_update(gid, cpu, mem, disk, gpu):
     """Update quota permissions"""
     display.vvv("DC/OS: update quota {}".format(gid))
 
+    api = dcos_api()
+    if api is not None:
+        _quota_api_update(api, [_quota_config(gid, cpu, mem, disk, gpu)])
+        return
+
     cmd = [
         'dcos',
         'quota',
@@ -106,6 +174,12 @@ def quota_delete(gid):
     """Delete a quota"""
     display.vvv("DC/OS: delete quota {}".format(gid))
 
+    api = dcos_api()
+    if api is not None:
+        # a quota without limits removes it
+        _quota_api_update(api, [{'role': gid, 'limits': {}}])
+        return
+
     cmd = [
         'dcos',
         'quota',
@@ -114,6 +188,40 @@ def quota_delete(gid):
     ]
     run_command(cmd, 'delete quota', stop_on_error=True)
 
+def apply_quotas(quotas, changes):
+    """Apply quota changes, in a single operator API call when possible.
+
+    :param quotas: current quotas indexed by role
+    :param changes: list of (action, gid, cpu, mem, disk, gpu) tuples
+    """
+    configs = {}
+    for action, gid, cpu, mem, disk, gpu in changes:
+        if action == 'delete':
+            configs[gid] = {'role': gid, 'limits': {}}
+        else:
+            configs[gid] = _quota_config(gid, cpu, mem, disk, gpu, quotas.get(gid))
+
+    api = dcos_api()
+    if api is not None:
+        display.vvv("DC/OS: update quotas {}".format(', '.join(sorted(configs))))
+        _quota_api_update(api, list(configs.values()))
+    else:
+        calls = []
+        for action, gid, cpu, mem, disk, gpu in changes:
+            if action == 'delete':
+                calls.append(partial(quota_delete, gid))
+            elif action == 'create':
+                calls.append(partial(quota_create, gid, cpu, mem, disk, gpu))
+            else:
+                calls.append(partial(quota_update, gid, cpu, mem, disk, gpu))
+        run_concurrently(calls, 'update quotas')
+
+    for action, gid, _, _, _, _ in changes:
+        if action == 'delete':
+            update_snapshot('quotas', gid)
+        else:
+            update_snapshot('quotas', gid, configs[gid])
+
 class ActionModule(ActionBase):
     def run(self, tmp=None, task_vars=None):
 
@@ -127,39 +235,43 @@ class ActionModule(ActionBase):
             return result
 
         args = self._task.args
-        gid = args.get('group_id')
-        cpu = args.get('cpu', None)
-        mem = args.get('mem', None)
-        disk = args.get('disk', None)
-        gpu = args.get('gpu', None)
 
-        wanted_state = args.get('state', 'present')
+        # either a list of quotas or the quota of a single role
+        wanted = args.get('quotas')
+        if wanted is None:
+            wanted = [args]
 
-        if gid is None:
-            raise AnsibleActionFail('gid cannot be empty for dcos_iam_quota')
+        for q in wanted:
+            if q.get('group_id') is None:
+                raise AnsibleActionFail('gid cannot be empty for dcos_iam_quota')
 
+        select_cluster(task_vars)
         ensure_dcos()
 
-        current_state = get_quota_state(gid)
-
-        if current_state == wanted_state:
-            
-            display.vvv(
-                "DC/OS quota {} already in desired state {}".format(gid, wanted_state))
-
-            if wanted_state == "present":
-                quota_update(gid, cpu, mem, disk, gpu)
-
-            result['changed'] = False
-        else:
-            display.vvv("DC/OS: quota {} not in desired state {}".format(gid, wanted_state))
-
-            if wanted_state != 'absent':
-                quota_create(gid, cpu, mem, disk, gpu)
+        quotas = get_snapshot('quotas', _list_quotas)
+
+        changes = []
+        for q in wanted:
+            gid = q.get('group_id')
+            cpu = q.get('cpu', None)
+            mem = q.get('mem', None)
+            disk = q.get('disk', None)
+            gpu = q.get('gpu', None)
+            wanted_state = q.get('state', 'present')
+
+            action = plan_quota(quotas, gid, cpu, mem, disk, gpu, wanted_state)
+            if action is None:
+                display.vvv(
+                    "DC/OS quota {} already in desired state {}".format(gid, wanted_state))
+                continue
 
-            else:
-                quota_delete(gid)
+            display.vvv("DC/OS: quota {} not in desired state {}, {}".format(
+                gid, wanted_state, action))
+            changes.append((action, gid, cpu, mem, disk, gpu))
 
-            result['changed'] = True
+        if changes:
+            apply_quotas(quotas, changes)
 
+        result['changed'] = len(changes) > 0
+        result['quotas'] = dict((gid, action) for action, gid, _, _, _, _ in changes)
         return result
@@ -6,6 +6,8 @@ Uses the Ansible host to connect directly to DC/OS.
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import binascii
+import hashlib
 import json
 import subprocess
 import tempfile
@@ -21,9 +23,16 @@ sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
 from action_plugins.common import (
     ensure_dcos,
+    select_cluster,
     ensure_dcos_security,
     run_command,
-    _dcos_path
+    _dcos_path,
+    dcos_api,
+    DcosApiError,
+    get_cluster_config,
+    get_snapshot,
+    update_snapshot,
+    persistent_cache
 )
 
 try:
@@ -32,11 +41,112 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+def _secret_path(path, store):
+    return '/secrets/v1/secret/{}/{}'.format(store, path.strip('/'))
+
+def list_secrets(prefix, store):
+    """List the paths of the secrets below a prefix, relative to the prefix."""
+    prefix = prefix.strip('/')
+
+    api = dcos_api()
+    if api is not None:
+        try:
+            r = api.get(_secret_path(prefix, store) + '?list=true')
+        except DcosApiError as e:
+            if e.status != 404:
+                raise
+            return []
+        return r.get('array') or []
+
+    p = subprocess.Popen([
+        'dcos',
+        'security',
+        'secrets',
+        'list',
+        '--store-id',
+        store,
+        '--json',
+        prefix or '/'
+        ],
+        env=_dcos_path(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = p.communicate()
+    message = (output + errors).decode('utf-8', 'replace')
+    # a prefix without any secrets below it is not found
+    if p.returncode != 0 and 'not found' in message.lower():
+        return []
+    if p.returncode != 0:
+        raise AnsibleActionFail('Failed to list secrets: {}'.format(message))
+    try:
+        return json.loads(output) or []
+    except ValueError:
+        raise AnsibleActionFail('Failed to list secrets: {}'.format(message))
+
+def _snapshot_kind(parent, store):
+    return 'secrets:{}:{}'.format(store, parent)
+
+def secret_exists(path, store):
+    """Check whether a secret exists without fetching its value.
+
+    The secrets next to it are listed once per run and shared by all tasks.
+    """
+    parent, _, name = path.strip('/').rpartition('/')
+    secrets = get_snapshot(
+        _snapshot_kind(parent, store),
+        lambda: dict((s, True) for s in list_secrets(parent, store)))
+    return name in secrets
+
+def _remember_exists(path, store, exists):
+    parent, _, name = path.strip('/').rpartition('/')
+    update_snapshot(_snapshot_kind(parent, store), name, True if exists else None)
+
+def _digest_key(path, store):
+    cluster = get_cluster_config().get('cluster_id')
+    return 'secret-digest:{}:{}:{}'.format(cluster, store, path.strip('/'))
+
+def secret_hasher(salt):
+    """Get a hash object for digests of secret values, to feed chunk by chunk."""
+    return hashlib.sha256(salt.encode())
+
+def secret_digest(salt, chunks):
+    """Get the salted digest of a secret value given as text or byte chunks."""
+    h = secret_hasher(salt)
+    for chunk in chunks:
+        h.update(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+    return h.hexdigest()
+
+def load_digest(path, store):
+    """Get the salt and digest recorded for the value last applied to a secret.
+
+    :return: tuple of salt and digest, the digest is None when nothing was
+             recorded and the salt is then a new one
+    """
+    record = persistent_cache().get(_digest_key(path, store))
+    if record is None:
+        return binascii.hexlify(os.urandom(16)).decode(), None
+    return record['salt'], record['digest']
+
+def save_digest(path, store, salt, digest):
+    """Record the digest of the value applied to a secret."""
+    persistent_cache().set(_digest_key(path, store), {'salt': salt, 'digest': digest})
+
+def forget_digest(path, store):
+    """Drop the digest record of a removed secret."""
+    persistent_cache().delete(_digest_key(path, store))
+
 def get_secret_value(path, store):
     """Get the current value of a secret."""
 
     display.vvv('looking for secret {} '.format(path))
 
+    api = dcos_api()
+    if api is not None:
+        try:
+            return api.get(_secret_path(path, store))['value']
+        except DcosApiError as e:
+            if e.status != 404:
+                raise
+            return None
+
     value = None
     try:
         r = subprocess.check_output([
@@ -53,7 +163,6 @@ def get_secret_value(path, store):
             stderr=subprocess.STDOUT
         )
         value = json.loads(r)['value']
-        display.vvv('secret {} has value {}'.format(path, value))
     except:
         value = None
 
@@ -62,7 +171,12 @@ def get_secret_value(path, store):
 def secret_create(path, value, store):
     """Create a secret"""
 
-    display.vvv("DC/OS: create secret {} with {}".format(path, value))
+    display.vvv("DC/OS: create secret {}".format(path))
+
+    api = dcos_api()
+    if api is not None:
+        api.put(_secret_path(path, store), {'value': value})
+        return
 
     cmd = [
         'dcos',
@@ -71,16 +185,22 @@ def secret_create(path, value, store):
         'create',
         '--store-id',
         store,
-        '--value',
-        value,
+        '-f',
+        '/dev/stdin',
         path
     ]
-    run_command(cmd, 'create secret', stop_on_error=True)
+    # the value goes on stdin to keep it out of the process list
+    run_command(cmd, 'create secret', stop_on_error=True, input=value or '', mask=(value,))
 
 def secret_update(path, value, store):
     """Update a secret"""
 
-    display.vvv("DC/OS: update secret {} with {}".format(path, value))
+    display.vvv("DC/OS: update secret {}".format(path))
+
+    api = dcos_api()
+    if api is not None:
+        api.patch(_secret_path(path, store), {'value': value})
+        return
 
     cmd = [
         'dcos',
@@ -89,17 +209,23 @@ def secret_update(path, value, store):
         'update',
         '--store-id',
         store,
-        '--value',
-        value,
+        '-f',
+        '/dev/stdin',
         path
     ]
-    run_command(cmd, 'update secret', stop_on_error=True)
+    # the value goes on stdin to keep it out of the process list
+    run_command(cmd, 'update secret', stop_on_error=True, input=value or '', mask=(value,))
 
 def secret_delete(path, store):
     """Delete a secret"""
 
     display.vvv("DC/OS: delete secret {}".format(path))
 
+    api = dcos_api()
+    if api is not None:
+        api.delete(_secret_path(path, store))
+        return
+
     cmd = [
         'dcos',
         'security',
@@ -130,13 +256,14 @@ class ActionModule(ActionBase):
         store = args.get('store', 'default')
         value = args.get('value')
         wanted_state = args.get('state', 'present')
+        # fetch the current value even when it matches the recorded digest
+        verify = args.get('verify', False)
 
+        select_cluster(task_vars)
         ensure_dcos()
         ensure_dcos_security()
 
-        current_value = get_secret_value(path, store)
-
-        current_state = 'present' if current_value is not None else 'absent'
+        current_state = 'present' if secret_exists(path, store) else 'absent'
 
         if current_state == wanted_state:
             
@@ -144,22 +271,32 @@ class ActionModule(ActionBase):
                 "DC/OS Secret {} already in desired state {}".format(path, wanted_state))
             result['changed'] = False
 
-            if wanted_state == "present" and current_value != value:
-                secret_update(path, value, store)
-                result['changed'] = True
-                result['msg'] = "Secret {} was updated".format(path)
+            if wanted_state == "present":
+                # only fetch the value when it may differ from what was applied last
+                salt, digest = load_digest(path, store)
+                wanted_digest = secret_digest(salt, [value or ''])
+                if verify or digest != wanted_digest:
+                    if get_secret_value(path, store) != value:
+                        secret_update(path, value, store)
+                        result['changed'] = True
+                        result['msg'] = "Secret {} was updated".format(path)
+                    save_digest(path, store, salt, wanted_digest)
 
         else:
             display.vvv("DC/OS Secret {} not in desired state {}".format(path, wanted_state))
 
             if wanted_state != 'absent':
                 secret_create(path, value, store)
+                salt, _ = load_digest(path, store)
+                save_digest(path, store, salt, secret_digest(salt, [value or '']))
                 result['msg'] = "Secret {} was created".format(path)
 
             else:
                 secret_delete(path, store)
+                forget_digest(path, store)
                 result['msg'] = "Secret {} was deleted".format(path)
 
+            _remember_exists(path, store, wanted_state != 'absent')
             result['changed'] = True
 
         return result
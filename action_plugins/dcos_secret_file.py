@@ -21,9 +21,21 @@ sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
 from action_plugins.common import (
     ensure_dcos,
+    select_cluster,
     ensure_dcos_security,
     run_command,
-    _dcos_path
+    _dcos_path,
+    dcos_api,
+    DCOS_HTTP_CHUNK_SIZE
+)
+from action_plugins.dcos_secret import (
+    secret_exists,
+    _remember_exists,
+    secret_hasher,
+    secret_digest,
+    load_digest,
+    save_digest,
+    forget_digest
 )
 
 try:
@@ -32,37 +44,69 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
-def get_secret_value(path, store):
-    """Get the current value of a secret."""
+def _secret_path(path, store):
+    return '/secrets/v1/secret/{}/{}'.format(store, path.strip('/'))
+
+def file_chunks(file):
+    """Read a file in fixed-size chunks."""
+    with open(file, 'rb') as f:
+        chunk = f.read(DCOS_HTTP_CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = f.read(DCOS_HTTP_CHUNK_SIZE)
+
+def get_secret_digest(path, store, salt):
+    """Get the salted digest of the current value of a secret.
+
+    The value is streamed into the digest, so it is never held in memory.
+    Returns None if the secret cannot be read.
+    """
 
     display.vvv('looking for secret {} '.format(path))
 
-    value = None
-    try:
-        r = subprocess.check_output([
-            'dcos',
-            'security',
-            'secrets',
-            'get',
-            '--store-id',
-            store,
-            path
-            ],
-            env=_dcos_path(),
-            stderr=subprocess.STDOUT
-        )
-        value = r
-        display.vvv('secret {} has value {}'.format(path, value))
-    except:
-        value = None
-
-    return value
+    h = secret_hasher(salt)
+
+    api = dcos_api()
+    if api is not None:
+        # secret_exists already checked that the secret is there
+        api.get(_secret_path(path, store), stream=h.update,
+                headers={'Accept': 'application/octet-stream'})
+        return h.hexdigest()
+
+    p = subprocess.Popen([
+        'dcos',
+        'security',
+        'secrets',
+        'get',
+        '--store-id',
+        store,
+        path
+        ],
+        env=_dcos_path(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    chunk = p.stdout.read(DCOS_HTTP_CHUNK_SIZE)
+    while chunk:
+        h.update(chunk)
+        chunk = p.stdout.read(DCOS_HTTP_CHUNK_SIZE)
+    p.communicate()
+    if p.returncode != 0:
+        return None
+    return h.hexdigest()
 
 def secret_create_from_file(path, file, store):
     """Create a secret from file"""
 
     display.vvv("DC/OS: create secret from file {} at path {}".format(file,path))
 
+    api = dcos_api()
+    if api is not None:
+        with open(file, 'rb') as f:
+            api.put(_secret_path(path, store), f,
+                    headers={'Content-Type': 'application/octet-stream'})
+        return
+
     cmd = [
         'dcos',
         'security',
@@ -81,6 +125,13 @@ def secret_update_from_file(path, file, store):
 
     display.vvv("DC/OS: update secret from file {} at path {}".format(file,path))
 
+    api = dcos_api()
+    if api is not None:
+        with open(file, 'rb') as f:
+            api.patch(_secret_path(path, store), f,
+                      headers={'Content-Type': 'application/octet-stream'})
+        return
+
     cmd = [
         'dcos',
         'security',
@@ -99,6 +150,11 @@ def secret_delete(path, store):
 
     display.vvv("DC/OS: delete secret {}".format(path))
 
+    api = dcos_api()
+    if api is not None:
+        api.delete(_secret_path(path, store))
+        return
+
     cmd = [
         'dcos',
         'security',
@@ -128,40 +184,52 @@ class ActionModule(ActionBase):
             raise AnsibleActionFail('path cannot be empty for dcos_secret')
         store = args.get('store', 'default')
         file = args.get('file')
-
-        with open(file, "rb") as wanted_value:
-
-            wanted_state = args.get('state', 'present')
-
-            ensure_dcos()
-            ensure_dcos_security()
-
-            current_value = get_secret_value(path, store)
-
-            current_state = 'present' if current_value is not None else 'absent'
-
-            if current_state == wanted_state:
-                
-                display.vvv(
-                    "DC/OS Secret {} already in desired state {}".format(path, wanted_state))
-                result['changed'] = False
-
-                if wanted_state == "present" and current_value != wanted_value:
-                    secret_update_from_file(path, file, store)
-                    result['changed'] = True
-                    result['msg'] = "Secret {} was updated".format(path)
+        wanted_state = args.get('state', 'present')
+        # fetch the current value even when the file matches the recorded digest
+        verify = args.get('verify', False)
+
+        if wanted_state == 'present' and file is None:
+            raise AnsibleActionFail('file cannot be empty for dcos_secret_file')
+
+        select_cluster(task_vars)
+        ensure_dcos()
+        ensure_dcos_security()
+
+        current_state = 'present' if secret_exists(path, store) else 'absent'
+
+        if current_state == wanted_state:
+            
+            display.vvv(
+                "DC/OS Secret {} already in desired state {}".format(path, wanted_state))
+            result['changed'] = False
+
+            if wanted_state == "present":
+                # only download the secret when the file may differ from what
+                # was uploaded last, and only upload when it actually differs
+                salt, digest = load_digest(path, store)
+                wanted_digest = secret_digest(salt, file_chunks(file))
+                if verify or digest != wanted_digest:
+                    if get_secret_digest(path, store, salt) != wanted_digest:
+                        secret_update_from_file(path, file, store)
+                        result['changed'] = True
+                        result['msg'] = "Secret {} was updated".format(path)
+                    save_digest(path, store, salt, wanted_digest)
+
+        else:
+            display.vvv("DC/OS Secret {} not in desired state {}".format(path, wanted_state))
+
+            if wanted_state != 'absent':
+                secret_create_from_file(path, file, store)
+                salt, _ = load_digest(path, store)
+                save_digest(path, store, salt, secret_digest(salt, file_chunks(file)))
+                result['msg'] = "Secret {} was created".format(path)
 
             else:
-                display.vvv("DC/OS Secret {} not in desired state {}".format(path, wanted_state))
+                secret_delete(path, store)
+                forget_digest(path, store)
+                result['msg'] = "Secret {} was deleted".format(path)
 
-                if wanted_state != 'absent':
-                    secret_create_from_file(path, file, store)
-                    result['msg'] = "Secret {} was created".format(path)
+            _remember_exists(path, store, wanted_state != 'absent')
+            result['changed'] = True
 
-                else:
-                    secret_delete(path, store)
-                    result['msg'] = "Secret {} was deleted".format(path)
-
-                result['changed'] = True
-
-            return result
+        return result
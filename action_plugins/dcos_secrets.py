@@ -0,0 +1,200 @@
+"""
+Action plugin to configure a DC/OS cluster.
+Uses the Ansible host to connect directly to DC/OS.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+
+from functools import partial
+
+from ansible.plugins.action import ActionBase
+from ansible.errors import AnsibleActionFail
+
+# to prevent duplicating code, make sure we can import common stuff
+sys.path.append(os.getcwd())
+sys.path.append(os.getcwd() + '/resources/ansible-dcos-module')
+from action_plugins.common import (
+    ensure_dcos,
+    select_cluster,
+    ensure_dcos_security,
+    run_concurrently
+)
+from action_plugins.dcos_secret import (
+    list_secrets,
+    _remember_exists,
+    secret_digest,
+    load_digest,
+    save_digest,
+    forget_digest,
+    get_secret_value,
+    secret_create,
+    secret_update,
+    secret_delete
+)
+from action_plugins.dcos_secret_file import (
+    file_chunks,
+    get_secret_digest,
+    secret_create_from_file,
+    secret_update_from_file
+)
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+def _join(prefix, path):
+    return '/'.join(p for p in (prefix.strip('/'), path.strip('/')) if p)
+
+def secrets_from_directory(directory, prefix):
+    """Get a file-based secret for every file below a directory.
+
+    The path of a secret is the path of its file relative to the directory,
+    below the prefix.
+    """
+    secrets = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            file = os.path.join(root, name)
+            rel = os.path.relpath(file, directory).replace(os.sep, '/')
+            secrets.append({'path': _join(prefix, rel), 'file': file})
+    return secrets
+
+def _common_prefix(paths):
+    """Get the deepest directory that contains all the secret paths."""
+    parts = [p.strip('/').split('/')[:-1] for p in paths]
+    common = []
+    for segments in zip(*parts):
+        if any(s != segments[0] for s in segments):
+            break
+        common.append(segments[0])
+    return '/'.join(common)
+
+def reconcile_secret(secret, exists, store, verify=False):
+    """Bring one secret into its wanted state.
+
+    :param exists: whether the secret is in the store according to the listing
+    :return: 'created', 'updated', 'deleted' or None when nothing changed
+    """
+    path = secret['path']
+    wanted_state = secret.get('state', 'present')
+    file = secret.get('file')
+    value = secret.get('value')
+
+    if wanted_state == 'absent':
+        if not exists:
+            return None
+        secret_delete(path, store)
+        _remember_exists(path, store, False)
+        forget_digest(path, store)
+        return 'deleted'
+
+    salt, digest = load_digest(path, store)
+    if file is not None:
+        wanted_digest = secret_digest(salt, file_chunks(file))
+    else:
+        wanted_digest = secret_digest(salt, [value or ''])
+
+    if not exists:
+        if file is not None:
+            secret_create_from_file(path, file, store)
+        else:
+            secret_create(path, value, store)
+        # patch the listings right away, other secrets may still fail
+        _remember_exists(path, store, True)
+        save_digest(path, store, salt, wanted_digest)
+        return 'created'
+
+    # only fetch the current value when it may differ from what was applied last
+    if not verify and digest == wanted_digest:
+        return None
+
+    action = None
+    if file is not None:
+        if get_secret_digest(path, store, salt) != wanted_digest:
+            secret_update_from_file(path, file, store)
+            action = 'updated'
+    elif get_secret_value(path, store) != value:
+        secret_update(path, value, store)
+        action = 'updated'
+    save_digest(path, store, salt, wanted_digest)
+    return action
+
+class ActionModule(ActionBase):
+    def run(self, tmp=None, task_vars=None):
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+
+        if self._play_context.check_mode:
+            # in --check mode, always skip this module execution
+            result['skipped'] = True
+            result['msg'] = 'The dcos task does not support check mode'
+            return result
+
+        args = self._task.args
+        store = args.get('store', 'default')
+        prefix = args.get('prefix')
+        directory = args.get('directory')
+        # fetch the current values even when they match the recorded digests
+        verify = args.get('verify', False)
+        # delete secrets below the prefix that are not listed
+        purge = args.get('purge', False)
+
+        wanted = []
+        for s in args.get('secrets') or []:
+            if s.get('path') is None:
+                raise AnsibleActionFail('every secret of dcos_secrets needs a path')
+            if s.get('state', 'present') == 'present' and 'value' not in s and s.get('file') is None:
+                raise AnsibleActionFail(
+                    'secret {} of dcos_secrets needs a value or file'.format(s['path']))
+            wanted.append(dict(s, path=_join(prefix or '', s['path'])))
+        if directory is not None:
+            if not os.path.isdir(directory):
+                raise AnsibleActionFail(
+                    'directory {} of dcos_secrets does not exist'.format(directory))
+            wanted.extend(secrets_from_directory(directory, prefix or ''))
+
+        if not wanted and not purge:
+            raise AnsibleActionFail('secrets or directory cannot be empty for dcos_secrets')
+        if purge and prefix is None:
+            raise AnsibleActionFail('purge needs a prefix for dcos_secrets')
+
+        paths = [s['path'] for s in wanted]
+        if len(set(paths)) != len(paths):
+            raise AnsibleActionFail('dcos_secrets got the same path more than once')
+
+        select_cluster(task_vars)
+        ensure_dcos()
+        ensure_dcos_security()
+
+        # one listing of the prefix tells which secrets exist
+        if prefix is None:
+            prefix = _common_prefix(paths)
+        existing = set(_join(prefix, p) for p in list_secrets(prefix, store))
+
+        if purge:
+            wanted.extend({'path': p, 'state': 'absent'}
+                          for p in sorted(existing - set(paths)))
+
+        actions = run_concurrently(
+            [partial(reconcile_secret, s, s['path'] in existing, store, verify)
+             for s in wanted],
+            'reconcile secrets')
+
+        changes = {}
+        for s, action in zip(wanted, actions):
+            if action is None:
+                continue
+            display.vvv("DC/OS: secret {} was {}".format(s['path'], action))
+            changes[s['path']] = action
+
+        result['changed'] = len(changes) > 0
+        result['secrets'] = changes
+        return result
@@ -39,6 +39,11 @@ options:
     private_key:
         description:
             - Path to file with private key
+    local_login:
+        description:
+            - Whether a service account with a private_key logs in without
+              the DC/OS CLI, this needs the cryptography package
+        default: true
 
 author:
     - Dirk Jonker (@dirkjonker)